@@ -0,0 +1,240 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import bisect
+import calendar
+import json
+import logging
+import numbers
+import struct
+import zlib
+import utils as sru
+
+# A .sra archive is a sequence of compressed blocks followed by an index:
+#
+#   header  MAGIC, codec (1 byte: 'm' for msgpack, 'j' for JSON)
+#   blocks  zlib(record, record, ...) where each record is a 4 byte length
+#           followed by the encoded activity
+#   index   zlib(entry, entry, ...) with one entry per activity holding its
+#           activityId, start epoch, block offset and position in the block
+#   footer  index offset, index length, activity count, FOOTER_MAGIC
+#
+# Index entries are sorted by start epoch, so range scans only decompress
+# the blocks they need and a single activity costs one block.
+
+MAGIC = b'SRA1'
+FOOTER_MAGIC = b'SRAX'
+EXTENSION = '.sra'
+
+_LENGTH = struct.Struct('<I')
+_ENTRY = struct.Struct('<qdQI')
+_FOOTER = struct.Struct('<QQQ4s')
+
+
+def _codec(name):
+    if name == b'm':
+        import msgpack
+        return (lambda a: msgpack.packb(a, use_bin_type=True),
+                lambda d: msgpack.unpackb(d, raw=False))
+    elif name == b'j':
+        return (lambda a: json.dumps(a, separators=(',', ':')).encode('utf-8'),
+                lambda d: json.loads(d.decode('utf-8')))
+    raise ValueError("Unknown archive codec %r" % (name))
+
+
+def _default_codec():
+    # msgpack is optional; JSON records still get the block compression
+    try:
+        import msgpack  # noqa
+        return b'm'
+    except ImportError:
+        return b'j'
+
+
+def _epoch(activity):
+    return calendar.timegm(sru.get_start_time(activity).utctimetuple())
+
+
+def is_archive(filename):
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+class ArchiveWriter(object):
+    """Write activities to a .sra archive
+
+    Activities should be written oldest to newest so that date range scans
+    touch as few blocks as possible; write_archive() takes care of that.
+    """
+
+    def __init__(self, filename, block_size=256, level=6, codec=None):
+        self.filename = filename
+        self.block_size = block_size
+        self.level = level
+        self.codec = codec or _default_codec()
+        self._encode = _codec(self.codec)[0]
+        self._fh = open(filename, 'wb')
+        self._fh.write(MAGIC + self.codec)
+        self._block = []
+        self._index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, activity, epoch=None):
+        self._block.append((_epoch(activity) if epoch is None else epoch, activity))
+        if len(self._block) >= self.block_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._block:
+            return
+        offset = self._fh.tell()
+        data = []
+        for position, (epoch, activity) in enumerate(self._block):
+            record = self._encode(activity)
+            data.append(_LENGTH.pack(len(record)))
+            data.append(record)
+            self._index.append((epoch, activity['activityId'], offset, position))
+        self._fh.write(zlib.compress(b''.join(data), self.level))
+        self._block = []
+
+    def close(self):
+        if self._fh is None:
+            return
+        self._flush()
+        self._index.sort()
+        index = zlib.compress(b''.join([_ENTRY.pack(i, e, o, p) for e, i, o, p in self._index]), self.level)
+        offset = self._fh.tell()
+        self._fh.write(index)
+        self._fh.write(_FOOTER.pack(offset, len(index), len(self._index), FOOTER_MAGIC))
+        self._fh.close()
+        self._fh = None
+        logging.debug("Wrote %d activities to %s" % (len(self._index), self.filename))
+
+
+def write_archive(filename, activities, **kwargs):
+    keyed = sorted([(_epoch(a), idx, a) for idx, a in enumerate(activities)], key=lambda x: x[:2])
+    with ArchiveWriter(filename, **kwargs) as writer:
+        for epoch, idx, activity in keyed:
+            writer.write(activity, epoch)
+
+
+class ActivityArchive(object):
+    """Read a .sra archive
+
+    Iterating yields activities in the order they were written (oldest to
+    newest for archives from write_archive()). get() fetches a single
+    activity by ID and scan() the activities that started in a date range.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fh = open(filename, 'rb')
+        header = self._fh.read(len(MAGIC) + 1)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not an activity archive" % (filename))
+        self._decode = _codec(header[len(MAGIC):])[1]
+
+        self._fh.seek(-_FOOTER.size, 2)
+        end = self._fh.tell()
+        offset, length, count, magic = _FOOTER.unpack(self._fh.read(_FOOTER.size))
+        if magic != FOOTER_MAGIC:
+            raise ValueError("%s is truncated or corrupt" % (filename))
+        self._fh.seek(offset)
+        index = zlib.decompress(self._fh.read(length))
+
+        # Blocks run from their offset up to the next block or the index
+        self._entries = [_ENTRY.unpack_from(index, n * _ENTRY.size) for n in range(count)]
+        self._epochs = [e[1] for e in self._entries]
+        self._by_id = dict([(e[0], e) for e in self._entries])
+        offsets = sorted(set([e[2] for e in self._entries]))
+        self._block_end = dict(zip(offsets, offsets[1:] + [offset]))
+        self._cached = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._fh.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, activity_id):
+        return activity_id in self._by_id
+
+    def _read_block(self, offset):
+        if self._cached[0] == offset:
+            return self._cached[1]
+        self._fh.seek(offset)
+        data = zlib.decompress(self._fh.read(self._block_end[offset] - offset))
+        records = []
+        position = 0
+        while position < len(data):
+            (length,) = _LENGTH.unpack_from(data, position)
+            position += _LENGTH.size
+            records.append(data[position:position + length])
+            position += length
+        self._cached = (offset, records)
+        return records
+
+    def _load(self, entry):
+        return self._decode(self._read_block(entry[2])[entry[3]])
+
+    def get(self, activity_id):
+        """Return the activity with the given ID, or None"""
+        entry = self._by_id.get(activity_id)
+        return None if entry is None else self._load(entry)
+
+    def scan(self, start=None, stop=None):
+        """Yield activities starting on or after start and before stop
+
+        start and stop are timezone aware datetimes or epoch seconds.
+        """
+        if start is not None and not isinstance(start, numbers.Real):
+            start = calendar.timegm(start.utctimetuple())
+        if stop is not None and not isinstance(stop, numbers.Real):
+            stop = calendar.timegm(stop.utctimetuple())
+        first = 0 if start is None else bisect.bisect_left(self._epochs, start)
+        last = len(self._epochs) if stop is None else bisect.bisect_left(self._epochs, stop)
+        for entry in self._entries[first:last]:
+            yield self._load(entry)
+
+    def __iter__(self):
+        # Walk the blocks in file order rather than through the index
+        for offset in sorted(self._block_end):
+            for record in self._read_block(offset):
+                yield self._decode(record)
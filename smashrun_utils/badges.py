@@ -28,21 +28,33 @@
 # POSSIBILITY OF SUCH DAMAGE. 
 
 
+import bisect
 import calendar
 import collections
 import copy
+import heapq
 import logging
 import math
 from datetime import timedelta
 from datetime import datetime
+import metrics
+import phases
 import utils as sru
 
 
 UNITS = sru.UNITS
 
+# Reported by add_activities() each time an activity earns a badge
+BadgeEarned = collections.namedtuple('BadgeEarned', ['badge_id', 'activity_id', 'date'])
+
+ACTIVITIES = metrics.counter('activities_evaluated', 'Activities added to a badge collection')
+DISPATCHES = metrics.counter('badge_dispatches', 'Activities handed to a badge or a shared accumulator', ('series',))
+
 
 class BadgeCollection(object):
     def __init__(self, **kwargs):
+        # Series that start on the same date share accumulators for badge families
+        kwargs.setdefault('accumulators', {})
         self._series = []
         self._series.append(TravisSeries(**kwargs))
         self._series.append(KellySeries(**kwargs))
@@ -56,6 +68,61 @@ class BadgeCollection(object):
             badges.extend(series.badges)
         return badges
 
+    @property
+    def acquired_badges(self):
+        return sorted([x for x in self.badges if x.acquired], key=lambda x: x.actualEarnedDate)
+
+    @property
+    def accumulators(self):
+        accumulators = []
+        for series in self._series:
+            accumulators.extend(series._accumulators)
+        return accumulators
+
+    def required_fields(self):
+        """Return the activity fields the badges in this collection need"""
+        fields = set()
+        for badge in self.badges:
+            fields |= badge.required_fields()
+        return fields
+
+    def wanted_fields(self):
+        """Return every activity field the badges in this collection can use"""
+        fields = set()
+        for badge in self.badges:
+            fields |= badge.wanted_fields()
+        return fields
+
+    def query_style(self):
+        """Return the smallest Smashrun query style with every required field"""
+        return sru.query_style(self.required_fields())
+
+    def deadline(self):
+        """Return the next time a badge changes without a new activity, or None
+
+        e.g. the day a run streak breaks or the end of a month for Stairs.
+        """
+        deadlines = [d for d in [s.deadline() for s in self._series] if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def advance_to(self, when):
+        """Bring time based badges up to date as of when, without a new activity
+
+        Streaks that would be broken by then are reset and months that have
+        ended are closed. Returns a BadgeEarned for every badge that earns.
+        when must be timezone aware.
+        """
+        events = []
+        for series in self._series:
+            events.extend(series.advance_to(when))
+        return sorted(events, key=lambda e: (e.date, e.badge_id))
+
+    def get_badge(self, badge_id):
+        for series in self._series:
+            if badge_id in series._badges:
+                return series._badges[badge_id]
+        return None
+
     def add_activity(self, activity):
         for series in self._series:
             series.add_activity(activity)
@@ -69,9 +136,37 @@ class BadgeCollection(object):
         else:
             logging.debug("%s: skipping activity %s that occured before %s" % (series.name, activity['activityId'], series.start_date))
 
+    def add_activities(self, activities):
+        """Add a batch of activities, yielding a BadgeEarned for every badge they earn
+
+        Activities are sorted by start time once and each series is handed the
+        slice starting at its own start date. Events from every series are
+        merged by date and yielded while the series are being processed, so
+        the generator must be consumed for the activities to be added.
+        """
+        with phases.phase('sort'):
+            decorated = sorted([(sru.get_start_time(a), idx, a) for idx, a in enumerate(activities)])
+            start_dates = [x[0] for x in decorated]
+            activities = [x[2] for x in decorated]
+        ACTIVITIES.inc(len(activities))
+
+        streams = []
+        for series in self._series:
+            first = bisect.bisect_left(start_dates, series.start_date)
+            if first > 0:
+                logging.debug("%s: skipping %d activities that occured before %s" % (series.name, first, series.start_date))
+            streams.append(((e.date, e.badge_id), e) for e in series.add_activities(activities[first:]))
+
+        for key, event in heapq.merge(*streams):
+            yield event
+
 
 class BadgeSeries(object):
-    def __init__(self, name, series_id, start_date, userinfo={}, user_badge_info={}, gender=None, birthday=None, id_filter=[]):
+    # Per-user attributes, packed with the badge state (see packed.py)
+    state = ('start_date',)
+
+    def __init__(self, name, series_id, start_date, userinfo={}, user_badge_info={}, gender=None, birthday=None, id_filter=[],
+                 accumulators=None, boundaries={}):
         self.name = name
         self.series_id = series_id
         self.start_date = start_date
@@ -82,7 +177,17 @@ class BadgeSeries(object):
         self.birthday = birthday
         self.gender = gender
         self.id_filter = copy.copy(id_filter)
+        # Activity field ('state' or 'countryCode') -> GeoJSON boundary file
+        self.boundaries = copy.copy(boundaries)
         self._badges = collections.OrderedDict()
+        # Badges that look at every activity themselves
+        self._activity_badges = []
+        # Accumulators this series feeds. Others with the same start date may
+        # register badges with them through the shared dictionary.
+        self._accumulators = []
+        self._shared_accumulators = {} if accumulators is None else accumulators
+        # Badges acquired since the last time add_activities() reported them
+        self._earned = []
 
     @property
     def badges(self):
@@ -90,14 +195,58 @@ class BadgeSeries(object):
 
     def add_badge(self, badge_id, instance):
         if len(self.id_filter) == 0 or badge_id in self.id_filter:
+            instance.id = badge_id
+            instance.earned_sink = self._earned
             self._badges[badge_id] = instance
             if badge_id in self.user_badge_info:
                 instance.add_user_badge_info(self.user_badge_info[badge_id])
 
+            if instance.accumulator is None:
+                self._activity_badges.append(instance)
+            else:
+                key = (instance.accumulator, self.start_date)
+                if key not in self._shared_accumulators:
+                    accumulator = instance.accumulator()
+                    accumulator.earned_sink = self._earned
+                    self._shared_accumulators[key] = accumulator
+                    self._accumulators.append(accumulator)
+                # The series feeding the accumulator reports what it earns
+                instance.earned_sink = self._shared_accumulators[key].earned_sink
+                self._shared_accumulators[key].add_badge(instance)
+
     def add_activity(self, activity):
-        for b in self._badges.values():
+        for accumulator in self._accumulators:
+            accumulator.add_activity(activity)
+        for b in self._activity_badges:
             b.add_activity(activity)
 
+    def add_activities(self, activities):
+        del self._earned[:]
+        for activity in activities:
+            self.add_activity(activity)
+            if self._earned:
+                earned = self._earned[:]
+                del self._earned[:]
+                for badge in earned:
+                    yield BadgeEarned(badge.id, badge.activityId, badge.actualEarnedDate)
+        DISPATCHES.inc(len(activities) * (len(self._accumulators) + len(self._activity_badges)), self.name)
+
+    def deadline(self):
+        deadlines = [b.deadline() for b in self._badges.values() if not b.acquired]
+        deadlines = [d for d in deadlines if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def advance_to(self, when):
+        del self._earned[:]
+        for badge in self._badges.values():
+            if not badge.acquired:
+                deadline = badge.deadline()
+                if deadline is not None and deadline <= when:
+                    badge.advance_to(when)
+        earned = [BadgeEarned(b.id, b.activityId, b.actualEarnedDate) for b in self._earned]
+        del self._earned[:]
+        return earned
+
 class TravisSeries(BadgeSeries):
     def __init__(self, userinfo={}, birthday=None, **kwargs):
         start_date = sru.srdate_to_datetime(userinfo['registrationDateUTC'], utc=True)
@@ -194,21 +343,21 @@ class ProSeries(BadgeSeries):
         start_date = sru.srdate_to_datetime(userinfo['proBadgeDateUTC'], utc=True)
         super(ProSeries, self).__init__('Pro series', 3, start_date, birthday=birthday, gender=gender, **kwargs)
 
-        self.add_badge(201, USofR())
-        self.add_badge(202, International())
+        self.add_badge(201, USofR(self.boundaries.get('state')))
+        self.add_badge(202, International(self.boundaries.get('countryCode')))
         self.add_badge(203, TopAndBottom())
         self.add_badge(204, FourCorners())
-        self.add_badge(205, InternationalSuperRunner())
+        self.add_badge(205, InternationalSuperRunner(self.boundaries.get('countryCode')))
         self.add_badge(206, SpecialAgent(birthday, gender))
         # self.add_badge(207, TBD_NCAAFitnessTest())
         self.add_badge(208, ForeignLegion())
         self.add_badge(209, SuperAgent(birthday, gender))
-        # self.add_badge(210, ArmyRanger())
-        # self.add_badge(211, TBD_FastStart5k())
-        # self.add_badge(212, TBD_FastFinish5k())
-        # self.add_badge(213, TBD_FastMiddle10k())
-        # self.add_badge(214, TBD_FastStartAndFinish5k())
-        # self.add_badge(215, TBD_SuperFastStart5k())
+        self.add_badge(210, ArmyRanger())
+        self.add_badge(211, FastStart5k())
+        self.add_badge(212, FastFinish5k())
+        self.add_badge(213, FastMiddle10k())
+        self.add_badge(214, FastStartAndFinish5k())
+        self.add_badge(215, SuperFastStart5k())
         self.add_badge(216, Sunriser())
         self.add_badge(217, FullMoonRunner())
         self.add_badge(218, Sunsetter())
@@ -252,8 +401,35 @@ class LimitedSeries(BadgeSeries):
         self.add_badge(151, TwentyFourHours())
 
 
+def _declared(cls, name):
+    # Union of a field declaration over every class a badge inherits from
+    result = set()
+    for klass in cls.__mro__:
+        result.update(klass.__dict__.get(name, ()))
+    return result
+
+
 class Badge(object):
+    # Badges in a family that track the same metric name the Accumulator
+    # class they share here
+    accumulator = None
+
+    # Activity fields the badge reads, added to those of its base classes.
+    # optional_fields are used when present (e.g. recordings, which only
+    # come with single detailed activities) but a run is still judged
+    # without them.
+    fields = ('activityId', 'startDateTimeLocal')
+    optional_fields = ()
+
+    # Attributes that change as activities are added or differ between users,
+    # added to those of its base classes. Everything else is the same for
+    # every user, which lets packed.py keep one set of badge objects and a
+    # small record of state per user.
+    state = ('activityId', 'actualEarnedDate', 'activities')
+
     def __init__(self, name, requires_unique_days=False):
+        self.id = None
+        self.earned_sink = None
         self.activityId = None
         self.actualEarnedDate = None
         self.info = {}
@@ -264,6 +440,18 @@ class Badge(object):
     def add_user_badge_info(self, info):
         self.info = copy.copy(info)
 
+    def required_fields(self):
+        fields = _declared(type(self), 'fields')
+        if self.accumulator is not None:
+            fields |= _declared(self.accumulator, 'fields')
+        return fields
+
+    def wanted_fields(self):
+        fields = self.required_fields() | _declared(type(self), 'optional_fields')
+        if self.accumulator is not None:
+            fields |= _declared(self.accumulator, 'optional_fields')
+        return fields
+
     @property
     def requirement(self):
         return self.info.setdefault('requirement', '')
@@ -286,11 +474,24 @@ class Badge(object):
     def _add_activity(self, activity):
         raise NotImplementedError("subclasses must implement _add_activity")
 
+    def deadline(self):
+        """Return when the badge's state next changes without a new activity, or None"""
+        return None
+
+    def advance_to(self, when):
+        """Apply the changes due by when (e.g. a streak broken by a missed day)
+
+        Only called once deadline() has passed.
+        """
+        pass
+
     def acquire(self, activity):
         if self.activityId is None:
             self.activityId = activity['activityId']
             self.actualEarnedDate = sru.get_start_time(activity)
             logging.info("%s: acquired from activity %s on %s" % (self.name, self.activityId, self.actualEarnedDate))
+            if self.earned_sink is not None:
+                self.earned_sink.append(self)
 
     @property
     def acquired(self):
@@ -313,6 +514,10 @@ class Badge(object):
 #
 ##################################################################
 class CountingBadge(Badge):
+    # Qualifying runs are logged with their distance and pace
+    fields = ('distance', 'duration')
+    state = ('count',)
+
     def __init__(self, name, limit, reset=0, **kwargs):
         super(CountingBadge, self).__init__(name, **kwargs)
         self.limit = limit
@@ -354,18 +559,257 @@ class CountingUnitsBadge(CountingBadge):
         self.units = units
 
 
+##################################################################
+#
+# Accumulators shared by a family of badges that track the same
+# metric and only differ by their thresholds. The metric is computed
+# once per activity no matter how many badges are in the family.
+#
+##################################################################
+class Accumulator(object):
+    # Activity fields the metric is computed from (see Badge.fields)
+    fields = ()
+    optional_fields = ()
+    # See Badge.state
+    state = ()
+
+    def __init__(self):
+        self.badges = []
+        self.earned_sink = None
+
+    def add_badge(self, badge):
+        self.badges.append(badge)
+
+    def add_activity(self, activity):
+        raise NotImplementedError("subclasses must implement add_activity")
+
+
+class LadderAccumulator(Accumulator):
+    # Badges are kept sorted by threshold. Earned badges are always a prefix
+    # of the ladder, so only the next unearned threshold needs to be checked.
+    state = ('next_badge', 'value')
+
+    def __init__(self):
+        super(LadderAccumulator, self).__init__()
+        self.thresholds = []
+        self.next_badge = 0
+        self.value = None
+
+    def add_badge(self, badge):
+        idx = bisect.bisect_right(self.thresholds, badge.threshold)
+        self.thresholds.insert(idx, badge.threshold)
+        self.badges.insert(idx, badge)
+
+    @property
+    def done(self):
+        return self.next_badge >= len(self.badges)
+
+    def add_activity(self, activity):
+        if self.done:
+            return
+
+        self.value = self.update(activity)
+        while not self.done and self.value >= self.thresholds[self.next_badge]:
+            self.badges[self.next_badge].acquire(activity)
+            self.next_badge += 1
+
+    def update(self, activity):
+        raise NotImplementedError("subclasses must implement update")
+
+
+class TotalDistanceAccumulator(LadderAccumulator):
+    fields = ('distance',)
+
+    def __init__(self):
+        super(TotalDistanceAccumulator, self).__init__()
+        self.value = 0 * UNITS.mile
+
+    def update(self, activity):
+        return self.value + sru.get_distance(activity)
+
+
+class TotalDurationAccumulator(LadderAccumulator):
+    fields = ('duration',)
+
+    def __init__(self):
+        super(TotalDurationAccumulator, self).__init__()
+        self.value = 0 * UNITS.hours
+
+    def update(self, activity):
+        return self.value + sru.get_duration(activity)
+
+
+class WeeklyDistanceAccumulator(LadderAccumulator):
+    fields = ('distance',)
+    state = ('runs',)
+
+    def __init__(self):
+        super(WeeklyDistanceAccumulator, self).__init__()
+        self.runs = collections.deque()  # (datetime, distance) tuples
+
+    def update(self, activity):
+        start_date = sru.get_start_time(activity)
+        # FIXME: Is it really 7 days like this or is it calendar days?
+        earliest_valid_date = start_date - timedelta(days=7)
+
+        while self.runs and self.runs[0][0] < earliest_valid_date:
+            self.runs.popleft()
+        self.runs.append((start_date, sru.get_distance(activity)))
+
+        return (0 * UNITS.mile) + sum([x[1] for x in self.runs])
+
+
+class MonthlyDistanceAccumulator(LadderAccumulator):
+    fields = ('distance',)
+    state = ('datetime_of_lastrun',)
+
+    def __init__(self):
+        super(MonthlyDistanceAccumulator, self).__init__()
+        self.datetime_of_lastrun = None
+
+    def update(self, activity):
+        start_date = sru.get_start_time(activity)
+        value = self.value
+        if sru.is_different_month(self.datetime_of_lastrun, start_date):
+            value = 0 * UNITS.mile
+
+        self.datetime_of_lastrun = start_date
+        return value + sru.get_distance(activity)
+
+
+class ElevationGainAccumulator(LadderAccumulator):
+    fields = ('elevationGain', 'isTreadmill')
+    optional_fields = ('recordingKeys', 'recordingValues')
+
+    def update(self, activity):
+        return sru.elevation_gain(activity)
+
+
+class MonthDaysAccumulator(Accumulator):
+    # Each badge in this family owns a different month, so only the badge
+    # for the month of the activity is looked at
+    state = ('counts', 'datetime_of_lastrun')
+
+    def __init__(self):
+        super(MonthDaysAccumulator, self).__init__()
+        self.months = {}
+        self.counts = {}
+        self.datetime_of_lastrun = {}
+
+    def add_badge(self, badge):
+        super(MonthDaysAccumulator, self).add_badge(badge)
+        self.months[badge.month] = badge
+        self.counts[badge.month] = 0
+
+    def add_activity(self, activity):
+        # FIXME: is using start date correct?
+        start_date = sru.get_start_time(activity)
+        badge = self.months.get(start_date.month)
+        if badge is None or badge.acquired:
+            return
+
+        # If we've changed years, reset
+        if sru.is_different_year(self.datetime_of_lastrun.get(badge.month), start_date):
+            self.counts[badge.month] = 0
+        self.datetime_of_lastrun[badge.month] = start_date
+
+        self.counts[badge.month] += 1
+        if self.counts[badge.month] * UNITS.day >= badge.limit:
+            badge.acquire(activity)
+
+
+class RunCountAccumulator(Accumulator):
+    # Every badge in this family keeps its own count of qualifying runs, but
+    # the values a run is judged on are only computed once
+    state = ('counts',)
+
+    def __init__(self):
+        super(RunCountAccumulator, self).__init__()
+        self.counts = []
+
+    def add_badge(self, badge):
+        super(RunCountAccumulator, self).add_badge(badge)
+        self.counts.append(0)
+
+    def add_activity(self, activity):
+        self.start_period(activity)
+        values = self.values(activity)
+        for idx, badge in enumerate(self.badges):
+            if badge.acquired:
+                continue
+            if badge.qualifies(*values):
+                self.counts[idx] += 1
+                if self.counts[idx] >= badge.limit:
+                    badge.acquire(activity)
+
+    def start_period(self, activity):
+        pass
+
+    def values(self, activity):
+        raise NotImplementedError("subclasses must implement values")
+
+
+class MonthlyPaceAccumulator(RunCountAccumulator):
+    fields = ('distance', 'duration')
+    state = ('datetime_of_lastrun',)
+
+    def __init__(self):
+        super(MonthlyPaceAccumulator, self).__init__()
+        self.datetime_of_lastrun = None
+
+    def start_period(self, activity):
+        start_date = sru.get_start_time(activity)
+
+        # Reset if we've changed months since the last activity
+        if sru.is_different_month(self.datetime_of_lastrun, start_date):
+            self.counts = [0] * len(self.counts)
+        self.datetime_of_lastrun = start_date
+
+    def values(self, activity):
+        return (sru.avg_pace(activity),)
+
+
+class PaceVariabilityAccumulator(RunCountAccumulator):
+    fields = ('distance', 'speedVariability')
+
+    def values(self, activity):
+        distance = sru.get_distance(activity)
+        variability = sru.get_pace_variability(activity)
+        logging.debug("%s: Distance: %s, PaceVariability: %s" % (sru.get_start_time(activity), distance, variability))
+        return (distance, variability)
+
+
+##################################################################
+#
+# Base for badges that belong to a family sharing an accumulator.
+# Outside of a BadgeSeries the badge feeds a private accumulator.
+#
+##################################################################
+class AccumulatedBadge(Badge):
+    _own_accumulator = None
+
+    @property
+    def threshold(self):
+        return self.limit
+
+    def _add_activity(self, activity):
+        if self._own_accumulator is None:
+            self._own_accumulator = self.accumulator()
+            self._own_accumulator.add_badge(self)
+        self._own_accumulator.add_activity(activity)
+
+
 ##################################################################
 #
 # Total time badges
 #
 ##################################################################
-class TotalTimeBadge(CountingUnitsBadge):
+class TotalTimeBadge(AccumulatedBadge, CountingUnitsBadge):
+    accumulator = TotalDurationAccumulator
+
     def __init__(self, name, limit, units=UNITS.hours):
         super(TotalTimeBadge, self).__init__(name, limit, units)
 
-    def increment(self, activity):
-        return sru.get_duration(activity)
-
 
 class ChariotsOfFire(TotalTimeBadge):
     def __init__(self):
@@ -449,6 +893,9 @@ class LunchHour(CountingUnitsBadge):
 #
 ##################################################################
 class RunStreakBadge(CountingBadge):
+    fields = ('distance',)
+    state = ('date_of_next_run',)
+
     def __init__(self, name, limit, days_between_runs=1, min_distance=None):
         limit = int(math.ceil(float(limit) / float(days_between_runs)))
         super(RunStreakBadge, self).__init__(name, limit, requires_unique_days=True)
@@ -485,6 +932,18 @@ class RunStreakBadge(CountingBadge):
 
         return result
 
+    def deadline(self):
+        # A run starting more than a day after the next one is due breaks
+        # the streak, so it's broken from the microsecond after that
+        if self.date_of_next_run is None or self.count == self._reset:
+            return None
+        return self.date_of_next_run + timedelta(days=1, microseconds=1)
+
+    def advance_to(self, when):
+        if when >= self.deadline():
+            logging.debug("%s broken due to no run on %s" % (self.name, self.date_of_next_run.strftime('%Y-%m-%d')))
+            self.reset()
+
 
 class OneMile(RunStreakBadge):
     def __init__(self):
@@ -556,6 +1015,8 @@ class ThreeSixtyFiveDays(CountingBadge):
 
 
 class ThreeSixtyFiveOf730(Badge):
+    state = ('runs',)
+
     def __init__(self):
         super(ThreeSixtyFiveOf730, self).__init__('365 of 730', requires_unique_days=True)
         self.runs = []
@@ -571,6 +1032,8 @@ class ThreeSixtyFiveOf730(Badge):
 
 
 class AYearInRunning(Badge):
+    state = ('enabled', 'last_available_start_time')
+
     def __init__(self, name='A year in running'):
         super(AYearInRunning, self).__init__(name, requires_unique_days=True)
         self.enabled = False
@@ -602,6 +1065,17 @@ class AYearInRunning(Badge):
         # Do it again tomorrow. Last available run time is tomorrow night at 23:59:59
         self.last_available_start_time = (start_date + timedelta(days=2)).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(microseconds=1)
 
+    def deadline(self):
+        # Broken from the microsecond after the last available start time
+        if not self.enabled or self.last_available_start_time is None:
+            return None
+        return self.last_available_start_time + timedelta(microseconds=1)
+
+    def advance_to(self, when):
+        if when >= self.deadline():
+            logging.info("%s: Streak broken on %s" % (self.name, self.last_available_start_time))
+            self.enabled = False
+
 
 class LeapYearSweep(AYearInRunning):
     def __init__(self):
@@ -619,13 +1093,12 @@ class LeapYearSweep(AYearInRunning):
 # of any number of runs
 #
 ##################################################################
-class TotalMileageBadge(CountingUnitsBadge):
+class TotalMileageBadge(AccumulatedBadge, CountingUnitsBadge):
+    accumulator = TotalDistanceAccumulator
+
     def __init__(self, name, limit, units=UNITS.mile):
         super(TotalMileageBadge, self).__init__(name, limit, units)
 
-    def increment(self, activity):
-        return sru.get_distance(activity)
-
 
 class TenUnderYourBelt(TotalMileageBadge):
     def __init__(self):
@@ -688,21 +1161,10 @@ class MiamiToronto(TotalMileageBadge):
 #
 ##################################################################
 class WeeklyTotalMileage(TotalMileageBadge):
+    accumulator = WeeklyDistanceAccumulator
+
     def __init__(self, name, limit, units=UNITS.mile):
         super(WeeklyTotalMileage, self).__init__(name, limit, units)
-        self.runs = []  # list of (datetime, distance) tuples
-
-    def increment(self, activity):
-        start_date = sru.get_start_time(activity)
-        # FIXME: Is it really 7 days like this or is it calendar days?
-        earliest_valid_date = start_date - timedelta(days=7)
-
-        self.runs = [x for x in self.runs if x[0] >= earliest_valid_date]
-        self.runs.append((start_date, sru.get_distance(activity)))
-
-        # Always reset since we're going to sum ourselves based on runs
-        self.reset()
-        return sum([x[1] for x in self.runs])
 
 
 class SolidWeek(WeeklyTotalMileage):
@@ -721,22 +1183,10 @@ class RockedTheWeek(WeeklyTotalMileage):
 #
 ##################################################################
 class MonthlyTotalMileageBadge(TotalMileageBadge):
+    accumulator = MonthlyDistanceAccumulator
+
     def __init__(self, name, limit, units=UNITS.mile):
         super(MonthlyTotalMileageBadge, self).__init__(name, limit, units)
-        self.datetime_of_lastrun = None
-
-    def increment(self, activity):
-        start_date = sru.get_start_time(activity)
-
-        is_new_month = False
-        if sru.is_different_month(self.datetime_of_lastrun, start_date):
-            is_new_month = True
-
-        if is_new_month:
-            self.reset()
-
-        self.datetime_of_lastrun = start_date
-        return sru.get_distance(activity)
 
 
 class SolidMonth(MonthlyTotalMileageBadge):
@@ -795,6 +1245,12 @@ class UltraMarathoner(SingleMileageBadge):
 
 
 class SingleMileageWithinDuration(CountingUnitsBadge):
+    optional_fields = ('recordingKeys', 'recordingValues')
+
+    # Whether the effort may be part of a longer run. Only used when the
+    # activity has distance and clock recordings.
+    allow_segments = False
+
     # Note most badges in this subclass are miles, so we change the default
     # units to miles
     def __init__(self, name, limit, duration, units=UNITS.miles):
@@ -805,15 +1261,26 @@ class SingleMileageWithinDuration(CountingUnitsBadge):
         if (sru.get_duration(activity)) < self.duration:
             self.reset()
             return sru.get_distance(activity)
+        elif self.allow_segments and activity.get('recordingKeys'):
+            # Imported here so numpy is only needed for detailed activities
+            import streams
+            best = streams.get_best_distance(activity, self.duration.to(UNITS.seconds).magnitude)
+            if best is not None:
+                self.reset()
+                return best * UNITS.meter
         return 0 * UNITS.kilometer
 
 
 class ArmyRanger(SingleMileageWithinDuration):
+    allow_segments = True
+
     def __init__(self):
         super(ArmyRanger, self).__init__('Army Ranger', 5, 40 * UNITS.minutes)
 
 
 class ForeignLegion(SingleMileageWithinDuration):
+    allow_segments = True
+
     def __init__(self):
         # Effectively a 12min cooper test
         super(ForeignLegion, self).__init__('Foreign Legion', 2800, 12 * UNITS.minutes + 5 * UNITS.seconds, units=UNITS.meters)
@@ -845,6 +1312,83 @@ class ClearedKate(SingleMileageWithinDuration):
         super(ClearedKate, self).__init__('Cleared Kate', 26.2, (5 * UNITS.hour) + (29 * UNITS.minute))
 
 
+##################################################################
+#
+# Badges judged on the run's splits. These need the distance and
+# clock recordings of a detailed activity; activities without them
+# are ignored.
+#
+##################################################################
+class SplitBadge(Badge):
+    optional_fields = ('recordingKeys', 'recordingValues')
+
+    def __init__(self, name, min_splits, split=1 * UNITS.kilometer):
+        super(SplitBadge, self).__init__(name)
+        self.min_splits = min_splits
+        self.split_length = split.to(UNITS.meter).magnitude
+
+    def _add_activity(self, activity):
+        if not activity.get('recordingKeys'):
+            return
+        # Imported here so numpy is only needed for detailed activities
+        import streams
+        splits = streams.get_splits(activity, self.split_length)
+        if splits is not None and len(splits) >= self.min_splits and self.qualifies(splits):
+            logging.debug("%s: splits %s qualify for ID=%s" % (self.name, splits, activity['activityId']))
+            self.acquire(activity)
+
+    def qualifies(self, splits):
+        raise NotImplementedError("subclasses must implement qualifies")
+
+
+# FIXME: Smashrun doesn't publish the exact criteria for 211-215. These
+# follow the badge names: complete splits only, judged on the whole run.
+class FastStart5k(SplitBadge):
+    def __init__(self):
+        # The first km of a 5k+ run is its fastest
+        super(FastStart5k, self).__init__('Fast Start', 5)
+
+    def qualifies(self, splits):
+        return splits[0] == min(splits)
+
+
+class FastFinish5k(SplitBadge):
+    def __init__(self):
+        # The last km of a 5k+ run is its fastest
+        super(FastFinish5k, self).__init__('Fast Finish', 5)
+
+    def qualifies(self, splits):
+        return splits[-1] == min(splits)
+
+
+class FastMiddle10k(SplitBadge):
+    def __init__(self):
+        # The fastest km of a 10k+ run is neither the first nor the last
+        super(FastMiddle10k, self).__init__('Fast Middle', 10)
+
+    def qualifies(self, splits):
+        return min(splits[1:-1]) < min(splits[0], splits[-1])
+
+
+class FastStartAndFinish5k(SplitBadge):
+    def __init__(self):
+        # The first and last kms of a 5k+ run are its two fastest
+        super(FastStartAndFinish5k, self).__init__('Fast Start and Finish', 5)
+
+    def qualifies(self, splits):
+        return max(splits[0], splits[-1]) <= min(splits[1:-1])
+
+
+class SuperFastStart5k(SplitBadge):
+    def __init__(self):
+        # The first km of a 5k+ run is 10% faster than the average of the rest
+        super(SuperFastStart5k, self).__init__('Super Fast Start', 5)
+
+    def qualifies(self, splits):
+        rest = splits[1:]
+        return splits[0] <= 0.9 * sum(rest) / len(rest)
+
+
 ##################################################################
 #
 # Badges that don't have an associated activity necessarily
@@ -881,6 +1425,8 @@ class GuineaPig(NoActivityBadge):
 
 
 class BirthdayRun(Badge):
+    state = ('birthday',)
+
     def __init__(self, birthday):
         super(BirthdayRun, self).__init__('Birthday Run')
         self.birthday = birthday
@@ -937,29 +1483,12 @@ class ColorPicker(NoActivityBadge):
 # In It For "X" Monthly Badges
 #
 ####################################################
-class InItForMonthBadge(CountingUnitsBadge):
+class InItForMonthBadge(AccumulatedBadge, CountingUnitsBadge):
+    accumulator = MonthDaysAccumulator
+
     def __init__(self, name, month):
         super(InItForMonthBadge, self).__init__(name, 10, UNITS.day, requires_unique_days=True)
         self.month = month
-        self.datetime_of_lastrun = None
-
-    def reset(self, log=True):
-        super(InItForMonthBadge, self).reset(log=log)
-
-    def increment(self, activity):
-        # FIXME: is using start date correct?
-        start_date = sru.get_start_time(activity)
-
-        # This isn't our month. Ignore
-        if start_date.month != self.month:
-            return 0 * UNITS.month
-
-        # If we've changed years, reset
-        if sru.is_different_year(self.datetime_of_lastrun, start_date):
-            self.reset()
-        self.datetime_of_lastrun = start_date
-
-        return 1 * UNITS.day
 
 
 class InItForJanuary(InItForMonthBadge):
@@ -1022,27 +1551,18 @@ class InItForDecember(InItForMonthBadge):
         super(InItForDecember, self).__init__('In it for December', 12)
 
 
-class AvgPaceBadge(CountingBadge):
+class AvgPaceBadge(AccumulatedBadge, CountingBadge):
+    accumulator = MonthlyPaceAccumulator
+
     def __init__(self, name, pace, limit=10, slower_ok=False):
         super(AvgPaceBadge, self).__init__(name, limit)
         self.pace = pace
-        self.datetime_of_lastrun = None
-        if slower_ok:
-            self.meets_criteria = lambda x, y: x >= y
-        else:
-            self.meets_criteria = lambda x, y: x <= y
-
-    def increment(self, activity):
-        start_date = sru.get_start_time(activity)
-
-        # Reset if we've changed months since the last activity
-        if sru.is_different_month(self.datetime_of_lastrun, start_date):
-            self.reset()
-        self.datetime_of_lastrun = start_date
+        self.slower_ok = slower_ok
 
-        if self.meets_criteria(sru.avg_pace(activity), self.pace):
-            return 1
-        return 0
+    def qualifies(self, pace):
+        if self.slower_ok:
+            return pace >= self.pace
+        return pace <= self.pace
 
 
 class EasyRunner(AvgPaceBadge):
@@ -1066,6 +1586,9 @@ class Mercury(AvgPaceBadge):
 
 
 class FastAndSlow(Badge):
+    fields = ('distance', 'duration')
+    state = ('fast', 'slow')
+
     def __init__(self):
         super(FastAndSlow, self).__init__('Fast & Slow')
         self.fast = 0
@@ -1086,6 +1609,10 @@ class FastAndSlow(Badge):
 #
 ####################################################
 class StairsBadge(Badge):
+    fields = ('distance',)
+    state = ('stepped', 'step_activity', 'cur_month', 'prev_month', 'consecutive_months', 'prev_activity_datetime',
+             'month_closed')
+
     def __init__(self, name, min_months, delta):
         super(StairsBadge, self).__init__(name)
         self.delta = delta
@@ -1096,30 +1623,51 @@ class StairsBadge(Badge):
         self.prev_month = 0 * UNITS.miles
         self.consecutive_months = 0
         self.prev_activity_datetime = None
+        # Set when advance_to() already closed the month of prev_activity_datetime
+        self.month_closed = False
 
     def update_cur_month_value(self, distance):
         self.cur_month += distance
 
+    def close_month(self):
+        # Figure out if the month of the last activity contained a step
+        if self.stepped:
+            self.consecutive_months += 1
+            result = 'STEP #%d' % (self.consecutive_months)
+        else:
+            # Sad trombone!
+            result = 'FAIL'
+            self.consecutive_months = 0
+
+        if self.prev_activity_datetime is not None:
+            logging.debug("%s: Distance for %s/%s: %s [%s]" %
+                          (self.name, self.prev_activity_datetime.month, self.prev_activity_datetime.year, self.cur_month, result))
+        self.stepped = False
+        self.prev_month = self.cur_month
+        self.cur_month = 0 * UNITS.miles
+
+    def deadline(self):
+        # The end of the month of the last activity
+        if self.prev_activity_datetime is None or self.month_closed:
+            return None
+        month_start = self.prev_activity_datetime.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        return (month_start + timedelta(days=32)).replace(day=1)
+
+    def advance_to(self, when):
+        if when >= self.deadline():
+            self.close_month()
+            self.month_closed = True
+            if self.consecutive_months >= self.min_months:
+                self.acquire(self.step_activity)
+
     def _add_activity(self, activity):
         start_date = sru.get_start_time(activity)
         distance = sru.get_distance(activity)
 
-        # If we walked into a new month, figure out if last month contained a step
-        if sru.is_different_month(self.prev_activity_datetime, start_date):
-            if self.stepped:
-                self.consecutive_months += 1
-                result = 'STEP #%d' % (self.consecutive_months)
-            else:
-                # Sad trombone!
-                result = 'FAIL'
-                self.consecutive_months = 0
-
-            if self.prev_activity_datetime is not None:
-                logging.debug("%s: Distance for %s/%s: %s [%s]" %
-                              (self.name, self.prev_activity_datetime.month, self.prev_activity_datetime.year, self.cur_month, result))
-            self.stepped = False
-            self.prev_month = self.cur_month
-            self.cur_month = 0 * UNITS.miles
+        # If we walked into a new month, close out the last one
+        if sru.is_different_month(self.prev_activity_datetime, start_date) and not self.month_closed:
+            self.close_month()
+        self.month_closed = False
 
         # Smashrun seems to round this way, so do it here too
         self.update_cur_month_value(round(distance.to(UNITS.miles).magnitude, 2) * UNITS.miles)
@@ -1130,10 +1678,10 @@ class StairsBadge(Badge):
                 if self.delta is None:
                     if self.cur_month > self.prev_month:
                         self.stepped = True
-                        self.step_activity = activity
+                        self.step_activity = sru.prune_activity(activity, Badge.fields)
                 elif self.cur_month > (self.prev_month + self.delta):
                     self.stepped = True
-                    self.step_activity = activity
+                    self.step_activity = sru.prune_activity(activity, Badge.fields)
 
         if self.consecutive_months >= self.min_months:
             self.acquire(self.step_activity)
@@ -1207,15 +1755,16 @@ class FurtherToFarther(FurtherBadge):
 # Elevation in a single run
 #
 ####################################################
-class SingleElevationBadge(Badge):
+class SingleElevationBadge(AccumulatedBadge):
+    accumulator = ElevationGainAccumulator
+
     def __init__(self, name, height):
         super(SingleElevationBadge, self).__init__(name)
         self.height = height
 
-    def _add_activity(self, activity):
-        delta = sru.elevation_gain(activity)
-        if delta >= self.height:
-            self.acquire(activity)
+    @property
+    def threshold(self):
+        return self.height
 
 
 class ToweredPisa(SingleElevationBadge):
@@ -1248,17 +1797,15 @@ class ToPikesPeak(SingleElevationBadge):
 # Elevation in a single month
 #
 ####################################################
-class MonthlyElevationBadge(CountingUnitsBadge):
+class MonthlyElevationBadge(AccumulatedBadge, CountingUnitsBadge):
+    # FIXME: The date of the last run was never recorded here, so the monthly
+    # total was reset on every activity and only a single run's elevation
+    # gain counted. That behavior is kept by sharing the per-run ladder with
+    # SingleElevationBadge. A real monthly total needs its own accumulator.
+    accumulator = ElevationGainAccumulator
+
     def __init__(self, name, limit, units=UNITS.meters):
         super(MonthlyElevationBadge, self).__init__(name, limit, units)
-        self.datetime_of_lastrun = None
-
-    def increment(self, activity):
-        start_date = sru.get_start_time(activity)
-        if sru.is_different_month(self.datetime_of_lastrun, start_date):
-            self.reset()
-
-        return sru.elevation_gain(activity)
 
 
 class TopOfTable(MonthlyElevationBadge):
@@ -1291,22 +1838,16 @@ class ConqueredEverest(MonthlyElevationBadge):
 # Pace variability badges
 #
 ####################################################
-class PaceVariabilityBadge(CountingBadge):
+class PaceVariabilityBadge(AccumulatedBadge, CountingBadge):
+    accumulator = PaceVariabilityAccumulator
+
     def __init__(self, name, limit, distance, tolerance):
         super(PaceVariabilityBadge, self).__init__(name, limit)
         self.distance = distance
         self.tolerance = tolerance
 
-    def increment(self, activity):
-        logging.debug("%s: Distance: %s (Min: %s), PaceVariability: %s (Max: %s)" %
-                      (sru.get_start_time(activity),
-                       sru.get_distance(activity).to(self.distance.units),
-                       self.distance,
-                       sru.get_pace_variability(activity),
-                       self.tolerance))
-        if sru.get_distance(activity) >= self.distance and sru.get_pace_variability(activity) <= self.tolerance:
-            return 1
-        return 0
+    def qualifies(self, distance, variability):
+        return distance >= self.distance and variability <= self.tolerance
 
 
 class ShortAndSteady(PaceVariabilityBadge):
@@ -1339,7 +1880,30 @@ class LongAndRockSolid(PaceVariabilityBadge):
 # Limited Badges
 #
 ####################################################
+def _agent_pace_table():
+    # Minimum speeds in km/h by agent type, gender and age
+    brackets = [(range(1, 30), 11.6027, 9.6027, 15.8008, 14.0168),
+                (range(30, 40), 11.2425, 9.0904, 15.2197, 13.0096),
+                (range(40, 50), 10.4704, 8.4291, 14.8048, 12.5042),
+                (range(50, 200), 9.5081, 7.5569, 13.8603, 10.9176)]
+    table = {'agent': {'male': {}, 'female': {}},
+             'superagent': {'male': {}, 'female': {}}}
+    for ages, agent_male, agent_female, superagent_male, superagent_female in brackets:
+        for i in ages:
+            table['agent']['male'][i] = agent_male
+            table['agent']['female'][i] = agent_female
+            table['superagent']['male'][i] = superagent_male
+            table['superagent']['female'][i] = superagent_female
+    return table
+
+
 class AgentBadge(Badge):
+    fields = ('distance', 'duration')
+    state = ('age', 'gender')
+
+    # Shared by every instance rather than built per badge
+    pace_table = _agent_pace_table()
+
     def __init__(self, name, birthday, gender, agent_type):
         super(AgentBadge, self).__init__(name)
         self.min_distance = 1.5 * UNITS.miles
@@ -1356,33 +1920,6 @@ class AgentBadge(Badge):
             self.gender = gender
         logging.debug("Agent using %dyo %s for data" % (self.age, self.gender))
 
-        self.pace_table = {'agent': { 'male': {}, 'female': {} }, 
-                           'superagent': { 'male': {}, 'female': {} }}
-
-        for i in range(1, 30):
-            self.pace_table['agent']['male'][i] = 11.6027
-            self.pace_table['agent']['female'][i] = 9.6027
-            self.pace_table['superagent']['male'][i] = 15.8008
-            self.pace_table['superagent']['female'][i] = 14.0168
-
-        for i in range(30, 40):
-            self.pace_table['agent']['male'][i] = 11.2425
-            self.pace_table['agent']['female'][i] = 9.0904
-            self.pace_table['superagent']['male'][i] = 15.2197
-            self.pace_table['superagent']['female'][i] = 13.0096
-
-        for i in range(40, 50):
-            self.pace_table['agent']['male'][i] = 10.4704
-            self.pace_table['agent']['female'][i] = 8.4291
-            self.pace_table['superagent']['male'][i] = 14.8048
-            self.pace_table['superagent']['female'][i] = 12.5042
-
-        for i in range(50, 200):
-            self.pace_table['agent']['male'][i] = 9.5081
-            self.pace_table['agent']['female'][i] = 7.5569
-            self.pace_table['superagent']['male'][i] = 13.8603
-            self.pace_table['superagent']['female'][i] = 10.9176
-
     def _add_activity(self, activity):
         distance = sru.get_distance(activity)
         if distance >= self.min_distance:
@@ -1410,13 +1947,35 @@ class SuperAgent(AgentBadge):
 #
 ####################################################
 class LocationAwareBadge(CountingBadge):
-    def __init__(self, name, limit, addr_key):
+    optional_fields = ('startLatitude', 'startLongitude')
+    state = ('locations',)
+
+    def __init__(self, name, limit, addr_key, boundaries=None):
         super(LocationAwareBadge, self).__init__(name, limit)
         self.addr_key = addr_key
+        # Only the file name is kept so pickled badge state stays small. The
+        # index itself is built once and shared.
+        self.boundaries = boundaries
         self.locations = set()
 
+    def get_location(self, activity):
+        if self.boundaries is None:
+            return sru.get_location(activity, self.addr_key)
+
+        # Imported activities may not have the field at all
+        value = activity.get(self.addr_key)
+        if value is None:
+            lat = activity.get('startLatitude')
+            lng = activity.get('startLongitude')
+            if lat is not None and lng is not None:
+                # Imported here so numpy is only needed when boundaries are used
+                import geocode
+                value = geocode.load_index(self.boundaries, self.addr_key).lookup(lat, lng)
+                logging.debug("Geocoded %s for activity ID=%s: %s" % (self.addr_key, activity['activityId'], value))
+        return value
+
     def increment(self, activity):
-        value = sru.get_location(activity, self.addr_key)
+        value = self.get_location(activity)
 
         delta = 0
         if value is not None:
@@ -1427,24 +1986,33 @@ class LocationAwareBadge(CountingBadge):
 
 
 class USofR(LocationAwareBadge):
-    def __init__(self):
-        super(USofR, self).__init__('U.S. of R.', 5, 'state')
+    fields = ('state',)
+
+    def __init__(self, boundaries=None):
+        super(USofR, self).__init__('U.S. of R.', 5, 'state', boundaries)
         self.states = set()
 
 
 class International(LocationAwareBadge):
-    def __init__(self):
-        super(International, self).__init__('International', 2, 'countryCode')
+    fields = ('countryCode',)
+
+    def __init__(self, boundaries=None):
+        super(International, self).__init__('International', 2, 'countryCode', boundaries)
         self.states = set()
 
 
 class InternationalSuperRunner(LocationAwareBadge):
-    def __init__(self):
-        super(InternationalSuperRunner, self).__init__('International Super Runner', 10, 'countryCode')
+    fields = ('countryCode',)
+
+    def __init__(self, boundaries=None):
+        super(InternationalSuperRunner, self).__init__('International Super Runner', 10, 'countryCode', boundaries)
         self.states = set()
 
 
 class TopAndBottom(Badge):
+    fields = ('startLatitude', 'startLongitude')
+    state = ('top', 'bottom')
+
     def __init__(self):
         super(TopAndBottom, self).__init__('Top and Bottom')
         self.top = False
@@ -1463,6 +2031,9 @@ class TopAndBottom(Badge):
 
 
 class FourCorners(Badge):
+    fields = ('startLatitude', 'startLongitude')
+    state = ('nw', 'ne', 'sw', 'se')
+
     def __init__(self):
         super(FourCorners, self).__init__('4 Corners')
         self.nw = False
@@ -1492,6 +2063,8 @@ class FourCorners(Badge):
 #
 ####################################################
 class FullMoonRunner(CountingBadge):
+    fields = ('moonPhase', 'sunriseLocal', 'sunsetLocal')
+
     def __init__(self):
         super(FullMoonRunner, self).__init__('Full Moon Runner', 10, requires_unique_days=True)
         self.full_pct = 96.0  # Value Chris says Smashrun uses
@@ -1507,6 +2080,9 @@ class FullMoonRunner(CountingBadge):
 
 
 class SolsticeBadge(Badge):
+    fields = ('duration', 'sunriseLocal', 'sunsetLocal')
+    state = ('sunrise', 'sunset')
+
     def __init__(self, name, solstice):
         super(SolsticeBadge, self).__init__(name)
         self.solstice = solstice
@@ -1538,6 +2114,8 @@ class ShortestDay(SolsticeBadge):
 
 
 class Sunriser(CountingBadge):
+    fields = ('sunriseLocal',)
+
     def __init__(self):
         super(Sunriser, self).__init__('Sunriser', 10, requires_unique_days=True)
 
@@ -1551,6 +2129,8 @@ class Sunriser(CountingBadge):
 
 
 class Sunsetter(CountingBadge):
+    fields = ('sunsetLocal',)
+
     def __init__(self):
         super(Sunsetter, self).__init__('Sunsetter', 10, requires_unique_days=True)
 
@@ -1569,9 +2149,13 @@ class Sunsetter(CountingBadge):
 #
 ####################################################
 class Corleone(Badge):
+    state = ('datetime_of_lastrun', 'due')
+
     def __init__(self):
         super(Corleone, self).__init__('Corleone')
         self.datetime_of_lastrun = None
+        # Set by advance_to() once it has been 30 days, so the next run earns it
+        self.due = False
 
     def _add_activity(self, activity):
         start_date = sru.get_start_time(activity)
@@ -1580,6 +2164,16 @@ class Corleone(Badge):
                 self.acquire(activity)
 
         self.datetime_of_lastrun = start_date
+        self.due = False
+
+    def deadline(self):
+        if self.datetime_of_lastrun is None or self.due:
+            return None
+        return self.datetime_of_lastrun + timedelta(days=30)
+
+    def advance_to(self, when):
+        if when >= self.deadline():
+            self.due = True
 
 
 class Veteran(NoActivityBadge):
@@ -1595,6 +2189,8 @@ class SmashrunForLife(NoActivityBadge):
 
 
 class TwentyFourHours(Badge):
+    fields = ('distance', 'duration')
+
     def __init__(self):
         super(TwentyFourHours, self).__init__('24 hours')
         self.min_time = 24 * UNITS.hours
@@ -0,0 +1,148 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import datetime
+import json
+import logging
+import os
+import time
+import yaml
+import ingest
+from badges import BadgeCollection
+
+# Workers import this module once (or inherit it across fork() from the
+# parent), so the pint registry in utils and the badge classes are set up a
+# single time per process and shared by every user that worker evaluates.
+
+
+def load_manifest(filename):
+    """Return the list of users described by a YAML manifest
+
+    Each user entry holds a 'name', 'birthday', 'gender', 'userinfo',
+    'badges' and 'input'. 'userinfo' and 'badges' may either be inline or the
+    name of a JSON file. Relative file names are resolved against the
+    directory holding the manifest.
+    """
+    with open(filename, 'r') as fh:
+        manifest = yaml.safe_load(fh)
+
+    if isinstance(manifest, dict):
+        manifest = manifest.get('users', [])
+
+    basedir = os.path.dirname(os.path.abspath(filename))
+    users = []
+    for user in manifest:
+        user = dict(user)
+        if 'name' not in user:
+            raise ValueError("Every user in %s must have a name" % (filename))
+        for key in ['userinfo', 'badges', 'input', 'credentials_file', 'country_boundaries', 'region_boundaries']:
+            value = user.get(key)
+            if isinstance(value, str) and not os.path.isabs(value):
+                user[key] = os.path.join(basedir, value)
+        users.append(user)
+    return users
+
+
+def _load_json(value, default=None):
+    if value is None:
+        return default
+    if isinstance(value, str):
+        with open(value, 'r') as fh:
+            return json.load(fh)
+    return value
+
+
+def _to_birthday(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def boundaries(country_boundaries=None, region_boundaries=None):
+    """Return the BadgeCollection boundaries argument for GeoJSON files"""
+    result = {}
+    if country_boundaries is not None:
+        result['countryCode'] = country_boundaries
+    if region_boundaries is not None:
+        result['state'] = region_boundaries
+    return result
+
+
+def collection_args(user):
+    """Return the BadgeCollection keyword arguments for a manifest entry"""
+    return {'userinfo': _load_json(user.get('userinfo'), {}),
+            'user_badge_info': _load_json(user.get('badges'), []),
+            'birthday': _to_birthday(user.get('birthday')),
+            'gender': user.get('gender'),
+            'id_filter': user.get('badgeid', []),
+            'boundaries': boundaries(user.get('country_boundaries'), user.get('region_boundaries'))}
+
+
+def load_activities(user, fields=None):
+    value = user.get('input')
+    if isinstance(value, str):
+        return list(ingest.iter_activities(value, fields))
+    return value or []
+
+
+def badge_to_dict(badge):
+    return {'id': badge.id,
+            'name': badge.name,
+            'activityId': badge.activityId,
+            'actualEarnedDate': badge.actualEarnedDate.isoformat()}
+
+
+def evaluate_user(user):
+    """Calculate earned badges for a single manifest entry
+
+    Returns the result as a single line of JSON so it can be streamed
+    straight out of a process pool
+    """
+    start_time = time.time()
+    result = {'name': user['name']}
+    try:
+        badgeset = BadgeCollection(**collection_args(user))
+
+        activities = load_activities(user, badgeset.wanted_fields())
+        earned = [badge_to_dict(b) for b in badgeset.acquired_badges]
+        for event in badgeset.add_activities(activities):
+            earned.append(badge_to_dict(badgeset.get_badge(event.badge_id)))
+
+        result['activities'] = len(activities)
+        result['badges'] = earned
+    except Exception as e:
+        logging.exception("%s: unable to calculate badges" % (user['name']))
+        result['error'] = str(e)
+
+    result['elapsed'] = round(time.time() - start_time, 3)
+    return json.dumps(result, sort_keys=True)
@@ -0,0 +1,66 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import json
+import logging
+import os
+import time
+
+# Userinfo and badge metadata rarely change, so they are cached locally
+# to let activities from --input be processed without touching the network.
+# The file holds {"fetched": <epoch seconds>, "userinfo": {...}, "badges": [...]}
+
+
+def load_user_cache(filename, max_age=None):
+    """Return (userinfo, badges) from a cache file
+
+    Returns None if the file doesn't exist or is older than max_age seconds.
+    A max_age of None accepts a cache of any age.
+    """
+    if not os.path.isfile(filename):
+        logging.debug("No user cache at %s" % (filename))
+        return None
+
+    with open(filename, 'r') as fh:
+        data = json.load(fh)
+
+    age = time.time() - data.get('fetched', 0)
+    if max_age is not None and age > max_age:
+        logging.info("User cache %s is stale (%.1f days old)" % (filename, age / 86400.0))
+        return None
+
+    logging.debug("Using user cache %s (%.1f days old)" % (filename, age / 86400.0))
+    return data['userinfo'], data['badges']
+
+
+def save_user_cache(filename, userinfo, badges):
+    data = {'fetched': time.time(), 'userinfo': userinfo, 'badges': badges}
+    with open(filename + '.tmp', 'w') as fh:
+        json.dump(data, fh, indent=2, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
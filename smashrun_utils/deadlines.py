@@ -0,0 +1,89 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import heapq
+import itertools
+import threading
+
+
+class DeadlineHeap(object):
+    """Keys (e.g. user names) ordered by their next deadline
+
+    Rescheduling a key leaves its old entry in the heap; stale entries are
+    skipped as they surface. Checking for expired deadlines only looks at
+    the keys that are due, however many keys there are.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}  # key -> sequence number of its live heap entry
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, deadline):
+        """Set (or with None, clear) the deadline for key"""
+        with self._lock:
+            if deadline is None:
+                self._entries.pop(key, None)
+                return
+            seq = next(self._counter)
+            self._entries[key] = seq
+            heapq.heappush(self._heap, (deadline, seq, key))
+            # Don't let stale entries pile up when keys are rescheduled often
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._heap = [x for x in self._heap if self._entries.get(x[2]) == x[1]]
+                heapq.heapify(self._heap)
+
+    def next_deadline(self):
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _drop_stale(self):
+        while self._heap and self._entries.get(self._heap[0][2]) != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self, when):
+        """Remove and return the keys whose deadline is at or before when, earliest first"""
+        due = []
+        with self._lock:
+            while True:
+                self._drop_stale()
+                if not self._heap or self._heap[0][0] > when:
+                    break
+                deadline, seq, key = heapq.heappop(self._heap)
+                del self._entries[key]
+                due.append(key)
+        return due
@@ -0,0 +1,255 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import collections
+import datetime
+import logging
+import math
+import time
+import numpy as np
+import utils as sru
+from badges import ElevationGainAccumulator
+from badges import MonthlyDistanceAccumulator
+from badges import RunStreakBadge
+from badges import SingleMileageBadge
+from badges import TotalDistanceAccumulator
+from badges import TotalDurationAccumulator
+
+
+UNITS = sru.UNITS
+
+# probability is the share of simulations that earned the badge within the
+# horizon. earliest/median/latest are the dates by which 10%, 50% and 90% of
+# simulations had earned it (None if that many never did). remaining is what
+# is still needed: a quantity for totals or a number of runs for streaks.
+BadgeForecast = collections.namedtuple('BadgeForecast', ['badge_id', 'name', 'probability', 'earliest', 'median', 'latest', 'remaining'])
+
+
+class ActivityModel(object):
+    """Empirical distribution of a user's recent running
+
+    Days between runs are sampled independently of the runs themselves.
+    Distance, duration and elevation gain are sampled together from the
+    same historical activity.
+    """
+
+    def __init__(self, activities, history_days=180):
+        if len(activities) == 0:
+            raise ValueError("Need at least one activity to forecast from")
+
+        starts = [sru.get_start_time(a) for a in activities]
+        self.last_start = max(starts)
+        earliest = self.last_start - datetime.timedelta(days=history_days)
+        recent = [(s, a) for s, a in zip(starts, activities) if s >= earliest]
+
+        run_days = sorted(set([s.date().toordinal() for s, a in recent]))
+        gaps = np.diff(run_days)
+        self.gaps = gaps if len(gaps) else np.array([7])
+        self.distances = np.array([sru.get_distance(a).magnitude for s, a in recent])
+        self.durations = np.array([sru.get_duration(a).magnitude for s, a in recent])
+        self.elevations = np.array([sru.elevation_gain(a).magnitude for s, a in recent])
+
+    def sample(self, rng, simulations, horizon):
+        """Return (days, distances, durations, elevations) arrays of shape (simulations, runs)
+
+        days counts the days from the last run. Enough runs are drawn for
+        nearly every simulation to reach the horizon.
+        """
+        runs = int(math.ceil(1.5 * horizon / max(self.gaps.mean(), 1.0))) + 10
+        days = np.cumsum(rng.choice(self.gaps, size=(simulations, runs)), axis=1)
+        idx = rng.randint(len(self.distances), size=(simulations, runs))
+        return days, self.distances[idx], self.durations[idx], self.elevations[idx]
+
+
+class BadgeForecaster(object):
+    """Monte Carlo projection of when unearned badges will be earned
+
+    Rather than copying badge objects for every simulated future, the state
+    of each supported badge family is reduced to a few numbers that are
+    broadcast over a batch of simulations and advanced with numpy. Supported
+    families are total distance and time, monthly distance, single-run
+    distance and elevation, and run streaks.
+    """
+
+    def __init__(self, collection, activities, simulations=1000, horizon=365, history_days=180, seed=None):
+        self.collection = collection
+        self.model = ActivityModel(activities, history_days=history_days)
+        self.simulations = simulations
+        self.horizon = horizon
+        self.seed = seed
+
+    def forecast(self):
+        """Return a BadgeForecast for every unearned badge that can be projected"""
+        start_time = time.time()
+        rng = np.random.RandomState(self.seed)
+        days, distances, durations, elevations = self.model.sample(rng, self.simulations, self.horizon)
+        self._run_days = days
+        self._days = np.where(days <= self.horizon, days, np.inf)
+        self._first_day = self.model.last_start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        results = []
+        for accumulator in self.collection.accumulators:
+            if isinstance(accumulator, TotalDistanceAccumulator):
+                results.extend(self._total(accumulator, distances, UNITS.kilometer))
+            elif isinstance(accumulator, TotalDurationAccumulator):
+                results.extend(self._total(accumulator, durations, UNITS.seconds))
+            elif isinstance(accumulator, MonthlyDistanceAccumulator):
+                results.extend(self._monthly(accumulator, distances, UNITS.kilometer))
+            elif isinstance(accumulator, ElevationGainAccumulator):
+                results.extend(self._single(accumulator.badges, accumulator.thresholds, elevations, UNITS.meters))
+
+        single = [b for b in self.collection.badges if isinstance(b, SingleMileageBadge)]
+        results.extend(self._single(single, [b.limit for b in single], distances, UNITS.kilometer))
+
+        streaks = [b for b in self.collection.badges if isinstance(b, RunStreakBadge) and not b.acquired]
+        daily = [b for b in streaks if b.days_between_runs == 1 and b.min_distance is None]
+        results.extend(self._daily_streaks(daily))
+        results.extend(self._streaks([b for b in streaks if b not in daily], distances))
+
+        logging.debug("Forecast %d badges over %d simulations in %.3fs" %
+                      (len(results), self.simulations, time.time() - start_time))
+        return sorted(results, key=lambda x: x.badge_id)
+
+    def _result(self, badge, earned, remaining):
+        ordered = np.sort(earned)
+        last = len(ordered) - 1
+
+        def date_at(fraction):
+            day = ordered[int(fraction * last)]
+            if np.isinf(day):
+                return None
+            return self._first_day + datetime.timedelta(days=int(day))
+
+        probability = float(np.isfinite(earned).mean())
+        return BadgeForecast(badge.id, badge.name, probability, date_at(0.1), date_at(0.5), date_at(0.9), remaining)
+
+    def _first_hit(self, hit):
+        # Day of the first run in each simulation for which hit is true
+        first = hit.argmax(axis=1)
+        days = self._days[np.arange(hit.shape[0]), first]
+        return np.where(hit.any(axis=1), days, np.inf)
+
+    def _total(self, accumulator, values, units):
+        current = accumulator.value.to(units).magnitude
+        totals = current + np.cumsum(values, axis=1)
+        results = []
+        for badge, threshold in zip(accumulator.badges, accumulator.thresholds):
+            if not badge.acquired:
+                earned = self._first_hit(totals >= threshold.to(units).magnitude)
+                results.append(self._result(badge, earned, (threshold - accumulator.value).to(threshold.units)))
+        return results
+
+    def _monthly(self, accumulator, values, units):
+        # Month of each simulated run, counted from the month of the last run
+        first_month = self._first_day.year * 12 + self._first_day.month
+        dates = [self._first_day + datetime.timedelta(days=i) for i in range(self.horizon + 1)]
+        month_of_day = np.array([(d.year * 12 + d.month) - first_month for d in dates])
+        months = month_of_day[np.where(np.isfinite(self._days), self._days, self.horizon).astype(int)]
+
+        # Running total within each month. Runs still in the current month
+        # carry on from the accumulator's value.
+        totals = np.cumsum(values, axis=1)
+        padded = np.hstack([np.zeros((totals.shape[0], 1)), totals])
+        new_month = np.hstack([months[:, :1] != 0, months[:, 1:] != months[:, :-1]])
+        month_start = np.maximum.accumulate(np.where(new_month, np.arange(totals.shape[1]), 0), axis=1)
+        current = accumulator.value.to(units).magnitude if accumulator.value is not None else 0.0
+        monthly = totals - padded[np.arange(totals.shape[0])[:, None], month_start] + np.where(months == 0, current, 0.0)
+
+        results = []
+        for badge, threshold in zip(accumulator.badges, accumulator.thresholds):
+            if not badge.acquired:
+                earned = self._first_hit(monthly >= threshold.to(units).magnitude)
+                remaining = threshold - (accumulator.value if accumulator.value is not None else 0 * threshold.units)
+                results.append(self._result(badge, earned, remaining.to(threshold.units)))
+        return results
+
+    def _single(self, badges, thresholds, values, units):
+        results = []
+        for badge, threshold in zip(badges, thresholds):
+            if not badge.acquired:
+                earned = self._first_hit(values >= threshold.to(units).magnitude)
+                results.append(self._result(badge, earned, threshold))
+        return results
+
+    def _daily_streaks(self, badges):
+        # Every run counts towards a daily streak without a minimum distance,
+        # so the streak length at each run follows from the gaps between runs
+        results = []
+        for (count, next_run), group in self._group_by_state(badges).items():
+            runs = np.arange(self._days.shape[1])
+            first = self._run_days[:, :1] == next_run if next_run is not None else np.zeros((self.simulations, 1), dtype=bool)
+            continues = np.hstack([first, np.diff(self._run_days, axis=1) == 1])
+            last_break = np.maximum.accumulate(np.where(continues, -1, runs), axis=1)
+            length = np.where(last_break >= 0, runs - last_break + 1, runs + 1 + count)
+            for b in group:
+                earned = self._first_hit(length >= b.limit)
+                results.append(self._result(b, earned, int(b.limit - b.count)))
+        return results
+
+    def _group_by_state(self, badges):
+        groups = collections.defaultdict(list)
+        for b in badges:
+            next_run = None if b.date_of_next_run is None else self._day_of(b.date_of_next_run)
+            groups[(b.count, next_run)].append(b)
+        return groups
+
+    def _streaks(self, badges, distances):
+        # Mirrors RunStreakBadge.increment() on whole days for every badge
+        # and simulation at once. Arrays are (badges, simulations). A badge
+        # without a next run date compares as -inf so its first run restarts
+        # the count at 1, just like a reset would.
+        if not badges:
+            return []
+
+        shape = (len(badges), self.simulations)
+        limit = np.array([b.limit for b in badges], dtype=float)[:, None]
+        spacing = np.array([b.days_between_runs for b in badges], dtype=float)[:, None]
+        min_distance = np.array([0.0 if b.min_distance is None else b.min_distance.to(UNITS.kilometer).magnitude
+                                 for b in badges])
+        count = np.array([b.count for b in badges], dtype=float)[:, None] * np.ones(shape)
+        next_day = np.array([-np.inf if b.date_of_next_run is None else self._day_of(b.date_of_next_run)
+                             for b in badges])[:, None] * np.ones(shape)
+        earned = np.full(shape, np.inf)
+
+        # (runs, badges, simulations) so each step reads contiguous memory
+        runs = int(np.isfinite(self._days).any(axis=0).sum())
+        qualifies = distances.T[:runs, None, :] >= min_distance[None, :, None]
+        for run in range(runs):
+            day = self._days[:, run]
+            eligible = qualifies[run] & (day >= next_day)
+            np.copyto(count, 0, where=eligible & (day > next_day))
+            np.add(count, eligible, out=count)
+            np.copyto(next_day, day + spacing, where=eligible)
+            np.copyto(earned, np.minimum(earned, day), where=eligible & (count >= limit))
+
+        return [self._result(b, earned[idx], int(b.limit - b.count)) for idx, b in enumerate(badges)]
+
+    def _day_of(self, dt):
+        # Whole days from the day of the last run, in local time
+        return (dt.replace(tzinfo=None) - self._first_day.replace(tzinfo=None)).days
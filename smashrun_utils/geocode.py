@@ -0,0 +1,197 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import collections
+import json
+import logging
+import math
+import os
+import threading
+import numpy as np
+import metrics
+
+# Reverse geocoding of start coordinates against GeoJSON boundaries, e.g.
+# Natural Earth's admin-0 countries and admin-1 states/provinces. Boundary
+# data isn't shipped with this package; point at a file you've downloaded.
+
+# Feature properties that hold the value Smashrun reports for each field
+PROPERTY_KEYS = {'countryCode': ['countryCode', 'ISO_A2', 'iso_a2', 'ISO_A2_EH'],
+                 'state': ['state', 'postal', 'POSTAL']}
+
+# Keep point x edge matrices to a reasonable size
+_MAX_CELLS = 1 << 20
+
+# Most recently looked up points remembered by each index
+LOOKUP_CACHE_SIZE = 4096
+
+_indexes = {}
+_stats = metrics.cache('geocode')
+
+
+def load_index(filename, field):
+    """Return the (shared) BoundaryIndex for field built from a GeoJSON file"""
+    key = (os.path.abspath(filename), field)
+    if key not in _indexes:
+        with open(filename, 'r') as fh:
+            data = json.load(fh)
+        _indexes[key] = BoundaryIndex(data.get('features', []), PROPERTY_KEYS.get(field, [field]))
+        logging.info("Loaded %d %s boundaries from %s" % (len(_indexes[key]), field, filename))
+    return _indexes[key]
+
+
+def _edges(rings):
+    # One row (x1, y1, x2, y2) per edge of every ring. Even-odd crossing
+    # counts over all rings treat inner rings as holes.
+    edges = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype=float)[:, :2]
+        if len(ring) < 3:
+            continue
+        edges.append(np.hstack([ring, np.roll(ring, -1, axis=0)]))
+    return np.vstack(edges) if edges else None
+
+
+def _contains(edges, x, y):
+    """Return a boolean array of which points (x, y) are inside edges"""
+    result = np.zeros(len(x), dtype=bool)
+    step = max(1, _MAX_CELLS // len(edges))
+    x1, y1, x2, y2 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    for first in range(0, len(x), step):
+        px = x[first:first + step, None]
+        py = y[first:first + step, None]
+        straddles = (y1 > py) != (y2 > py)
+        # Horizontal edges never straddle, so their NaN crossings don't count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing = (x2 - x1) * (py - y1) / (y2 - y1) + x1
+            inside = np.count_nonzero(straddles & (px < crossing), axis=1) % 2 == 1
+        result[first:first + step] = inside
+    return result
+
+
+class BoundaryIndex(object):
+    """Point in polygon lookups over a set of GeoJSON features
+
+    Polygons are bucketed into a grid of cell_size degree cells by their
+    bounding boxes, so a point is only tested against the few polygons whose
+    boxes cover its cell.
+    """
+
+    def __init__(self, features, keys, cell_size=1.0):
+        self.cell_size = float(cell_size)
+        self.values = []
+        self.edges = []
+        self.bboxes = []
+        self.grid = {}
+        # (lat, lng) -> value, least recently used first
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        for feature in features:
+            properties = feature.get('properties') or {}
+            value = None
+            for key in keys:
+                if properties.get(key) not in (None, '', '-99'):
+                    value = properties[key]
+                    break
+            geometry = feature.get('geometry') or {}
+            if value is None or geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+                continue
+
+            polygons = geometry['coordinates']
+            if geometry['type'] == 'Polygon':
+                polygons = [polygons]
+            for rings in polygons:
+                edges = _edges(rings)
+                if edges is not None:
+                    self._add(value, edges)
+
+    def __len__(self):
+        return len(self.values)
+
+    def _cell(self, value):
+        return int(math.floor(value / self.cell_size))
+
+    def _add(self, value, edges):
+        idx = len(self.values)
+        bbox = (edges[:, 0].min(), edges[:, 1].min(), edges[:, 0].max(), edges[:, 1].max())
+        self.values.append(value)
+        self.edges.append(edges)
+        self.bboxes.append(bbox)
+        for cx in range(self._cell(bbox[0]), self._cell(bbox[2]) + 1):
+            for cy in range(self._cell(bbox[1]), self._cell(bbox[3]) + 1):
+                self.grid.setdefault((cx, cy), []).append(idx)
+
+    def lookup(self, lat, lng):
+        """Return the value of the boundary holding (lat, lng), or None"""
+        key = (lat, lng)
+        with self._cache_lock:
+            if key in self._cache:
+                _stats.hits += 1
+                value = self._cache.pop(key)
+                self._cache[key] = value
+                return value
+        _stats.misses += 1
+        value = self.lookup_many([lat], [lng])[0]
+        with self._cache_lock:
+            self._cache[key] = value
+            while len(self._cache) > LOOKUP_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return value
+
+    def lookup_many(self, lats, lngs):
+        """Return a list with the value for each (lat, lng) pair, or None"""
+        x = np.asarray(lngs, dtype=float)
+        y = np.asarray(lats, dtype=float)
+        result = [None] * len(x)
+        if len(x) == 0:
+            return result
+
+        cx = np.floor(x / self.cell_size).astype(np.int64)
+        cy = np.floor(y / self.cell_size).astype(np.int64)
+        cells, inverse = np.unique(np.column_stack([cx, cy]), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='mergesort')
+        groups = np.split(order, np.cumsum(np.bincount(inverse, minlength=len(cells)))[:-1])
+
+        for cell, pending in zip(cells, groups):
+            for idx in self.grid.get((int(cell[0]), int(cell[1])), []):
+                bbox = self.bboxes[idx]
+                px = x[pending]
+                py = y[pending]
+                candidates = (px >= bbox[0]) & (px <= bbox[2]) & (py >= bbox[1]) & (py <= bbox[3])
+                if not candidates.any():
+                    continue
+                inside = np.zeros(len(pending), dtype=bool)
+                inside[candidates] = _contains(self.edges[idx], px[candidates], py[candidates])
+                for point in pending[inside]:
+                    result[point] = self.values[idx]
+                pending = pending[~inside]
+                if len(pending) == 0:
+                    break
+        return result
@@ -0,0 +1,183 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import datetime
+import heapq
+import json
+import logging
+import os
+import tempfile
+import archive
+import utils as sru
+from dateutil.tz import tzutc
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=tzutc())
+
+
+def activity_epoch(activity):
+    return (sru.get_start_time(activity) - EPOCH).total_seconds()
+
+
+def iter_json_array(fh, chunk_size=1 << 16):
+    """Iterate over the elements of a JSON array without loading the whole file
+
+    Files that don't start with '[' are read as JSON Lines instead.
+    """
+    decoder = json.JSONDecoder()
+    buf = fh.read(chunk_size).lstrip()
+    if not buf.startswith('['):
+        for line in _iter_lines(buf, fh):
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    buf = buf[1:]
+    eof = False
+    while True:
+        buf = buf.lstrip().lstrip(',').lstrip()
+        if buf.startswith(']'):
+            return
+        try:
+            value, end = decoder.raw_decode(buf)
+        except ValueError:
+            if eof:
+                raise
+            # Grow geometrically so large activities aren't re-parsed too often
+            data = fh.read(max(chunk_size, len(buf)))
+            eof = len(data) == 0
+            buf += data
+            continue
+        yield value
+        buf = buf[end:]
+
+
+def iter_activities(filename, fields=None):
+    """Iterate over the activities in a JSON, JSON Lines or .sra archive file
+
+    If fields is given every other field is dropped as activities are read.
+    """
+    if archive.is_archive(filename):
+        fh = archive.ActivityArchive(filename)
+        activities = iter(fh)
+    else:
+        fh = open(filename, 'r')
+        activities = iter_json_array(fh)
+    try:
+        for activity in activities:
+            yield activity if fields is None else sru.prune_activity(activity, fields)
+    finally:
+        fh.close()
+
+
+def _iter_lines(buf, fh):
+    # buf holds the part of the file that has already been read
+    lines = buf.split('\n')
+    for line in lines[:-1]:
+        yield line
+    partial = lines[-1]
+    for line in fh:
+        yield partial + line
+        partial = ''
+    if partial:
+        yield partial
+
+
+def _spill(run, tmpdir):
+    run.sort()
+    fh = tempfile.TemporaryFile(mode='w+', dir=tmpdir)
+    for record in run:
+        fh.write(json.dumps(record))
+        fh.write('\n')
+    fh.seek(0)
+    return fh
+
+
+def _read_run(fh):
+    for line in fh:
+        yield tuple(json.loads(line))
+
+
+def merge_activities(filenames, run_size=10000, tmpdir=None, fields=None):
+    """Yield the activities from several export files sorted by start time
+
+    Activities that appear more than once (by activityId) are only yielded
+    once. The version from the newest file wins, where files are ordered by
+    modification time and then by their position in filenames. At most
+    run_size activities are held in memory while reading. Larger histories
+    are spilled to sorted temporary files which are then merged. If fields
+    is given every other field is dropped as activities are read.
+    """
+    order = sorted(range(len(filenames)), key=lambda i: (os.path.getmtime(filenames[i]), i))
+    rank = dict([(i, r) for r, i in enumerate(order)])
+
+    # activityId -> (file rank, position) of the version to keep
+    winners = {}
+    runs = []
+    run = []
+    count = 0
+    for idx, filename in enumerate(filenames):
+        for position, activity in enumerate(iter_activities(filename, fields)):
+            version = [rank[idx], position]
+            activity_id = activity['activityId']
+            if activity_id not in winners or winners[activity_id] < version:
+                winners[activity_id] = version
+            run.append((activity_epoch(activity), activity_id, version, activity))
+            count += 1
+            if len(run) >= run_size:
+                runs.append(_spill(run, tmpdir))
+                run = []
+
+    logging.info("Merging %d activities (%d unique) from %d files" % (count, len(winners), len(filenames)))
+    try:
+        if runs:
+            if run:
+                runs.append(_spill(run, tmpdir))
+            merged = heapq.merge(*[_read_run(fh) for fh in runs])
+        else:
+            run.sort()
+            merged = iter(run)
+
+        for epoch, activity_id, version, activity in merged:
+            if winners[activity_id] == list(version):
+                yield activity
+    finally:
+        for fh in runs:
+            fh.close()
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,163 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import json
+import logging
+import os
+import archive
+import ingest
+
+# A journal is an append-only file of JSON lines recording sr-fixdates'
+# progress, so an interrupted run can pick up where it stopped:
+#
+#   {"event": "listed", "ids": [...]}                  activities in range
+#   {"event": "downloaded", "activity": {...}}          fetched, not yet checked
+#   {"event": "verified", "id": N}                      offset was already right
+#   {"event": "fixed", "activity": {...}}               corrected and sent back
+#
+# Only the file offset and start time of each activity are kept in memory;
+# activities are read back from the journal when they're needed. A record
+# torn by a crash is dropped when the journal is reopened.
+
+
+class Journal(object):
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.listed = None
+        self.verified = set()
+        self._index = {}
+        if resume and os.path.isfile(filename):
+            self._replay()
+        else:
+            open(filename, 'w').close()
+        self._fh = open(filename, 'a')
+        self._reader = open(filename, 'r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for fh in (self._fh, self._reader):
+            if fh is not None:
+                fh.close()
+        self._fh = self._reader = None
+
+    def _replay(self):
+        good = 0
+        with open(self.filename, 'r') as fh:
+            while True:
+                offset = fh.tell()
+                line = fh.readline()
+                if not line.endswith('\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(record, offset)
+                good = fh.tell()
+
+        if good != os.path.getsize(self.filename):
+            logging.warning("Dropping a partial record at the end of %s" % (self.filename))
+            with open(self.filename, 'r+') as fh:
+                fh.truncate(good)
+        logging.info("Resuming from %s: %d downloaded, %d verified" % (self.filename, len(self._index), len(self.verified)))
+
+    def _apply(self, record, offset):
+        event = record['event']
+        if event == 'listed':
+            self.listed = record['ids']
+        elif event == 'verified':
+            self.verified.add(record['id'])
+        else:
+            activity = record['activity']
+            self._index[activity['activityId']] = (ingest.activity_epoch(activity), offset)
+            if event == 'fixed':
+                self.verified.add(activity['activityId'])
+
+    def _append(self, record):
+        offset = self._fh.tell()
+        self._fh.write(json.dumps(record, sort_keys=True) + '\n')
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._apply(record, offset)
+
+    def list(self, ids):
+        self._append({'event': 'listed', 'ids': ids})
+
+    def downloaded(self, activity):
+        self._append({'event': 'downloaded', 'activity': activity})
+
+    def verify(self, activity_id):
+        self._append({'event': 'verified', 'id': activity_id})
+
+    def fixed(self, activity):
+        self._append({'event': 'fixed', 'activity': activity})
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, activity_id):
+        return activity_id in self._index
+
+    def get(self, activity_id):
+        """Return the latest recorded version of an activity"""
+        self._reader.seek(self._index[activity_id][1])
+        return json.loads(self._reader.readline())['activity']
+
+    def ids(self):
+        """Recorded activity IDs, oldest to newest"""
+        return [x[1] for x in sorted((epoch, activity_id) for activity_id, (epoch, offset) in self._index.items())]
+
+    def __iter__(self):
+        for activity_id in self.ids():
+            yield self.get(activity_id)
+
+    def export(self, filename):
+        """Write every recorded activity, oldest to newest, to a JSON or archive file
+
+        Activities are streamed from the journal one at a time into a
+        temporary file that replaces filename once it's complete.
+        """
+        if filename.endswith(archive.EXTENSION):
+            with archive.ArchiveWriter(filename + '.tmp') as writer:
+                for activity_id in self.ids():
+                    writer.write(self.get(activity_id), self._index[activity_id][0])
+        else:
+            # Matches the layout of json.dump(activities, fh, indent=2)
+            with open(filename + '.tmp', 'w') as fh:
+                fh.write('[')
+                for count, activity in enumerate(self):
+                    fh.write(',\n  ' if count else '\n  ')
+                    fh.write(json.dumps(activity, indent=2).replace('\n', '\n  '))
+                fh.write('\n]' if len(self) else ']')
+        os.rename(filename + '.tmp', filename)
@@ -0,0 +1,302 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+# Counters and latency histograms exposed in the OpenMetrics text format.
+# Everything registers with the module level REGISTRY; render() produces the
+# text for a scrape and write() saves it to a file at the end of a run.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Status codes worth retrying on idempotent calls
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values)]
+    return '{%s}' % (','.join(pairs))
+
+
+def percentile(values, pct):
+    """Return the nearest ranked pct percentile of values"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+class Counter(object):
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+    def samples(self):
+        lines = ['# TYPE %s counter' % (self.name), '# HELP %s %s' % (self.name, self.documentation)]
+        for labelvalues, value in sorted(self.values.items()):
+            lines.append('%s_total%s %s' % (self.name, _labels(self.labelnames, labelvalues), repr(float(value))))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labelvalues -> [bucket counts..., sum, count]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            data = self.values.setdefault(labelvalues, [0] * (len(self.buckets) + 2))
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                data[idx] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def samples(self):
+        lines = ['# TYPE %s histogram' % (self.name), '# HELP %s %s' % (self.name, self.documentation)]
+        names = self.labelnames + ('le',)
+        for labelvalues, data in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _labels(names, labelvalues + (repr(float(bound)),)), cumulative))
+            lines.append('%s_bucket%s %d' % (self.name, _labels(names, labelvalues + ('+Inf',)), data[-1]))
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labelnames, labelvalues), repr(float(data[-2]))))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labelnames, labelvalues), data[-1]))
+        return lines
+
+
+class CacheStats(object):
+    """Hit and miss counts for a cache
+
+    Plain attributes rather than a Counter so hot paths only pay for an
+    integer increment.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def cache(self, name):
+        with self._lock:
+            if name not in self.caches:
+                self.caches[name] = CacheStats(name)
+            return self.caches[name]
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].samples())
+        if self.caches:
+            lines.append('# TYPE cache_requests counter')
+            lines.append('# HELP cache_requests Lookups in in-memory caches')
+            for name in sorted(self.caches):
+                stats = self.caches[name]
+                lines.append('cache_requests_total{cache="%s",result="hit"} %s' % (name, repr(float(stats.hits))))
+                lines.append('cache_requests_total{cache="%s",result="miss"} %s' % (name, repr(float(stats.misses))))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+cache = REGISTRY.cache
+render = REGISTRY.render
+
+
+def write(filename):
+    """Write every metric to filename in the OpenMetrics text format"""
+    with open(filename + '.tmp', 'w') as fh:
+        fh.write(render())
+    os.rename(filename + '.tmp', filename)
+
+
+def summary():
+    """Return a short human readable summary of call latencies and caches"""
+    lines = []
+    calls = REGISTRY.metrics.get('outbound_call_seconds')
+    if calls is not None:
+        for labelvalues, data in sorted(calls.values.items()):
+            lines.append("%s.%s: %d calls, %.2fs total, %.1fms avg" %
+                         (labelvalues + (data[-1], data[-2], 1000.0 * data[-2] / data[-1])))
+    for name in sorted(REGISTRY.caches):
+        stats = REGISTRY.caches[name]
+        lines.append("%s cache: %d hits, %d misses (%.1f%%)" % (name, stats.hits, stats.misses, 100.0 * stats.ratio))
+    return lines
+
+
+##################################################################
+#
+# Outbound calls
+#
+##################################################################
+def _http_requests():
+    return counter('http_requests', 'HTTP requests by service, method and status code', ('service', 'method', 'status'))
+
+
+def _http_bytes():
+    return counter('http_response_bytes', 'Bytes received in HTTP responses', ('service',))
+
+
+def _http_seconds():
+    return histogram('http_request_seconds', 'HTTP request latency as reported by requests', ('service',))
+
+
+def _call_seconds():
+    return histogram('outbound_call_seconds', 'Latency of client calls, including paging', ('service', 'call'))
+
+
+def _retries():
+    return counter('outbound_retries', 'Calls retried after a 429 or 5xx response', ('service', 'call'))
+
+
+def observe_response(service, response):
+    """Record the status, size and latency of a requests response"""
+    _http_requests().inc(1, service, response.request.method if response.request else 'GET', response.status_code)
+    _http_bytes().inc(len(response.content or b''), service)
+    _http_seconds().observe(response.elapsed.total_seconds(), service)
+
+
+def instrument_session(session, service):
+    """Record every response a requests session receives"""
+    def hook(response, *args, **kwargs):
+        observe_response(service, response)
+        return response
+    session.hooks.setdefault('response', []).append(hook)
+    return session
+
+
+def _status(exception):
+    response = getattr(exception, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def timed_call(service, name, func, retries=0, backoff=1.0):
+    """Wrap func so its latency is recorded
+
+    Calls failing with a retryable status are tried again up to retries
+    times. Only use retries for idempotent calls.
+    """
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                _call_seconds().observe(time.time() - start_time, service, name)
+                if attempt >= retries or _status(e) not in RETRY_STATUS:
+                    raise
+                attempt += 1
+                _retries().inc(1, service, name)
+                logging.warning("%s.%s failed with %s, retrying (%d/%d)" % (service, name, _status(e), attempt, retries))
+                time.sleep(backoff * (2 ** (attempt - 1)))
+                continue
+            _call_seconds().observe(time.time() - start_time, service, name)
+            return result
+    return wrapper
+
+
+def timed_iterator(service, name, func):
+    """Wrap a function returning an iterator, recording the time spent in it"""
+    def wrapper(*args, **kwargs):
+        elapsed = 0.0
+        start_time = time.time()
+        iterator = iter(func(*args, **kwargs))
+        elapsed += time.time() - start_time
+        try:
+            while True:
+                start_time = time.time()
+                try:
+                    item = next(iterator)
+                finally:
+                    elapsed += time.time() - start_time
+                yield item
+        except StopIteration:
+            return
+        finally:
+            _call_seconds().observe(elapsed, service, name)
+    return wrapper
+
+
+def instrument_client(client, retries=2):
+    """Instrument a Smashrun client in place and return it"""
+    if getattr(client, 'session', None) is not None:
+        instrument_session(client.session, 'smashrun')
+    for name in ['get_activity', 'get_userinfo', 'get_badges']:
+        setattr(client, name, timed_call('smashrun', name, getattr(client, name), retries=retries))
+    client.update_activity = timed_call('smashrun', 'update_activity', client.update_activity)
+    client.get_activities = timed_iterator('smashrun', 'get_activities', client.get_activities)
+    return client
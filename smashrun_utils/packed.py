@@ -0,0 +1,315 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import collections
+import datetime
+import struct
+import threading
+import zlib
+import utils as sru
+from badges import BadgeCollection
+from badges import BadgeEarned
+from badges import _declared
+from dateutil.tz import tzoffset
+
+# A BadgeCollection is ~130 badge objects, most of which only hold
+# definitions (names, thresholds, units) that are the same for every user.
+# The attributes that aren't are declared by each class as 'state'. This
+# packs those into a record laid out in the order of a Layout: the state
+# names of every series, badge and accumulator in the collection, so only
+# values are stored, each as a type tag and a compact encoding. The record
+# is then compressed; a typical history packs to 1-1.5KB.
+#
+# UserStates hosts many users this way. Users whose collections have the
+# same shape (the same badge filter and boundary files, and whether their
+# Pro series starts with the others) share one set of badge objects. A
+# user's record is unpacked into it to add activities and packed again
+# afterwards, so only the record is kept per user.
+
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _DATETIME, _QUANTITY, _LIST, _TUPLE, _DEQUE, _SET, _DICT = range(13)
+_DATETIME_US = 13
+
+_DOUBLE = struct.Struct('<d')
+_SIGNATURE = struct.Struct('<I')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# UTC offsets are stored in seconds, with this for naive datetimes
+NAIVE = 1 << 20
+
+# Units quantities are stored in, by index. Only append to this.
+UNIT_NAMES = ('mile', 'kilometer', 'meter', 'foot', 'hour', 'minute', 'second', 'day')
+_UNIT_INDEX = dict([(name, idx) for idx, name in enumerate(UNIT_NAMES)])
+_UNITS = [sru.UNITS(name).units for name in UNIT_NAMES]
+_UNIT_CACHE = {}
+_TZ = {}
+
+try:
+    _STRING_TYPES = (str, unicode)
+    _INT_TYPES = (int, long)
+except NameError:
+    _STRING_TYPES = (str,)
+    _INT_TYPES = (int,)
+
+
+def _put_varint(out, value):
+    # Zigzag so small negative numbers stay small
+    value = value << 1 if value >= 0 else ((-value) << 1) - 1
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (value >> 1) ^ -(value & 1), pos
+
+
+def _tz(offset):
+    if offset not in _TZ:
+        _TZ[offset] = tzoffset(None, offset)
+    return _TZ[offset]
+
+
+def encode(value, out):
+    """Append the encoding of value to the bytearray out"""
+    if value is None:
+        out.append(_NONE)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, _INT_TYPES):
+        out.append(_INT)
+        _put_varint(out, value)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out.extend(_DOUBLE.pack(value))
+    elif isinstance(value, _STRING_TYPES):
+        data = value.encode('utf-8')
+        out.append(_STR)
+        _put_varint(out, len(data))
+        out.extend(data)
+    elif isinstance(value, datetime.datetime):
+        # Wall clock seconds (and microseconds if there are any) and the UTC offset
+        offset = value.utcoffset()
+        delta = value.replace(tzinfo=None) - EPOCH
+        out.append(_DATETIME_US if delta.microseconds else _DATETIME)
+        _put_varint(out, delta.days * 86400 + delta.seconds)
+        if delta.microseconds:
+            _put_varint(out, delta.microseconds)
+        _put_varint(out, NAIVE if offset is None else offset.days * 86400 + offset.seconds)
+    elif isinstance(value, sru.UNITS.Quantity):
+        units = value.units
+        if units not in _UNIT_CACHE:
+            _UNIT_CACHE[units] = _UNIT_INDEX[str(units)]
+        out.append(_QUANTITY)
+        _put_varint(out, _UNIT_CACHE[units])
+        encode(value.magnitude, out)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _put_varint(out, len(value))
+        for k, v in value.items():
+            encode(k, out)
+            encode(v, out)
+    else:
+        for tag, types in [(_LIST, list), (_TUPLE, tuple), (_DEQUE, collections.deque), (_SET, (set, frozenset))]:
+            if isinstance(value, types):
+                out.append(tag)
+                _put_varint(out, len(value))
+                for item in value:
+                    encode(item, out)
+                return
+        if hasattr(value, 'item'):
+            # numpy scalars
+            return encode(value.item(), out)
+        raise TypeError("Can't pack %s" % (type(value).__name__))
+
+
+def decode(data, pos):
+    """Return (value, position after it) for the value encoded at data[pos]"""
+    tag = data[pos]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _INT:
+        return _get_varint(data, pos)
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + _DOUBLE.size
+    if tag == _STR:
+        length, pos = _get_varint(data, pos)
+        return bytes(data[pos:pos + length]).decode('utf-8'), pos + length
+    if tag == _DATETIME or tag == _DATETIME_US:
+        seconds, pos = _get_varint(data, pos)
+        micros = 0
+        if tag == _DATETIME_US:
+            micros, pos = _get_varint(data, pos)
+        offset, pos = _get_varint(data, pos)
+        value = EPOCH + datetime.timedelta(seconds=seconds, microseconds=micros)
+        return (value if offset == NAIVE else value.replace(tzinfo=_tz(offset))), pos
+    if tag == _QUANTITY:
+        unit, pos = _get_varint(data, pos)
+        magnitude, pos = decode(data, pos)
+        return sru.UNITS.Quantity(magnitude, _UNITS[unit]), pos
+    if tag == _DICT:
+        length, pos = _get_varint(data, pos)
+        result = {}
+        for i in range(length):
+            k, pos = decode(data, pos)
+            result[k], pos = decode(data, pos)
+        return result, pos
+
+    length, pos = _get_varint(data, pos)
+    items = []
+    for i in range(length):
+        item, pos = decode(data, pos)
+        items.append(item)
+    if tag == _LIST:
+        return items, pos
+    if tag == _TUPLE:
+        return tuple(items), pos
+    if tag == _DEQUE:
+        return collections.deque(items), pos
+    if tag == _SET:
+        return set(items), pos
+    raise ValueError("Bad tag %d at %d" % (tag, pos - 1))
+
+
+class Layout(object):
+    """The state attributes of a collection's series, badges and accumulators, in order"""
+
+    def __init__(self, collection):
+        self.slots = []
+        for series in collection._series:
+            for obj in [series] + list(series._badges.values()) + series._accumulators:
+                self.slots.append((obj, tuple(sorted(_declared(type(obj), 'state')))))
+        shape = repr([(type(obj).__name__, names) for obj, names in self.slots])
+        self.signature = zlib.crc32(shape.encode('utf-8')) & 0xffffffff
+
+
+def pack_state(collection, layout=None):
+    """Return the per-user state of a collection as bytes"""
+    if layout is None:
+        layout = Layout(collection)
+    out = bytearray()
+    for obj, names in layout.slots:
+        for name in names:
+            encode(getattr(obj, name), out)
+    return _SIGNATURE.pack(layout.signature) + zlib.compress(bytes(out), 1)
+
+
+def unpack_state(collection, data, layout=None):
+    """Restore state from pack_state() into a collection with the same layout"""
+    if layout is None:
+        layout = Layout(collection)
+    if _SIGNATURE.unpack_from(data, 0)[0] != layout.signature:
+        raise ValueError("Packed state is for a different set of badges")
+    data = bytearray(zlib.decompress(data[_SIGNATURE.size:]))
+    pos = 0
+    for obj, names in layout.slots:
+        for name in names:
+            value, pos = decode(data, pos)
+            setattr(obj, name, value)
+    return collection
+
+
+def shape(id_filter=[], boundaries={}, userinfo={}, **kwargs):
+    """Return a key that's the same for users whose collections share a layout"""
+    same_start = userinfo['proBadgeDateUTC'] == userinfo['registrationDateUTC']
+    return (tuple(sorted(id_filter)), tuple(sorted(boundaries.items())), same_start)
+
+
+class UserStates(object):
+    """Badge state for many users, each held as a packed record"""
+
+    def __init__(self):
+        self._shapes = {}  # shape -> (collection, layout, lock)
+        self._users = {}  # name -> (shape, packed state)
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, name):
+        return name in self._users
+
+    @property
+    def nbytes(self):
+        """Bytes of packed state held for all users"""
+        return sum([len(x[1]) for x in self._users.values()])
+
+    def _shared(self, key, kwargs):
+        if key not in self._shapes:
+            collection = BadgeCollection(**kwargs)
+            self._shapes[key] = (collection, Layout(collection), threading.Lock())
+        return self._shapes[key]
+
+    def add_user(self, name, **kwargs):
+        """Add a user with the BadgeCollection arguments for them"""
+        key = shape(**kwargs)
+        collection = BadgeCollection(**kwargs)
+        layout = Layout(collection)
+        if layout.signature != self._shared(key, kwargs)[1].signature:
+            raise ValueError("%s: badges don't match others with the same shape" % (name))
+        self._users[name] = (key, pack_state(collection, layout))
+
+    def state(self, name):
+        return self._users[name][1]
+
+    def set_state(self, name, data):
+        key = self._users[name][0]
+        self._users[name] = (key, data)
+
+    def add_activities(self, name, activities):
+        """Add activities for a user, returning a BadgeEarned for each badge earned"""
+        key, data = self._users[name]
+        collection, layout, lock = self._shapes[key]
+        with lock:
+            unpack_state(collection, data, layout)
+            events = list(collection.add_activities(activities))
+            self._users[name] = (key, pack_state(collection, layout))
+        return events
+
+    def earned(self, name):
+        """Return a BadgeEarned for every badge the user has earned"""
+        key, data = self._users[name]
+        collection, layout, lock = self._shapes[key]
+        with lock:
+            unpack_state(collection, data, layout)
+            return [BadgeEarned(b.id, b.activityId, b.actualEarnedDate) for b in collection.acquired_badges]
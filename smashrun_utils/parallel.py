@@ -0,0 +1,273 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import json
+import logging
+import multiprocessing
+import numpy as np
+import utils as sru
+from badges import BadgeCollection
+from badges import BadgeEarned
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8. RawArray buffers are handed to the workers when the pool
+    # starts instead of being attached by name.
+    shared_memory = None
+    from multiprocessing.sharedctypes import RawArray
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Evaluate one large history on several cores. Badges don't depend on each
+# other, so each worker evaluates a share of them over the same activities.
+# The activities are sorted once and laid out as columns in a single shared
+# memory buffer which every worker reads, rather than each being sent its
+# own pickled copy.
+#
+# Column kinds:
+#   i  int64 values          f  float64 values          b  bool as uint8
+#   s  UTF-8 strings         j  anything else as JSON
+# Every column also has a state per activity: 0 missing, 1 None, 2 a value.
+# Variable length kinds (s, j) are a byte blob plus start offsets.
+
+MISSING, NONE, PRESENT = 0, 1, 2
+
+_worker = {}
+
+
+def _column_kind(values):
+    kinds = set()
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            kinds.add('b')
+        elif isinstance(value, int):
+            kinds.add('i')
+        elif isinstance(value, float):
+            kinds.add('f')
+        elif isinstance(value, string_types):
+            kinds.add('s')
+        else:
+            return 'j'
+    if len(kinds) == 1:
+        return kinds.pop()
+    return 'j'
+
+
+def _encode_blob(values, encode):
+    data = [b'' if v is None else encode(v) for v in values]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(d) for d in data])
+    return {'offsets': offsets, 'blob': np.frombuffer(b''.join(data) or b'\0', dtype=np.uint8)}
+
+
+def to_columns(activities):
+    """Return {field: (kind, {name: array})} for a list of activities"""
+    fields = []
+    for activity in activities:
+        for key in activity:
+            if key not in fields:
+                fields.append(key)
+
+    columns = {}
+    for field in fields:
+        values = [a.get(field) for a in activities]
+        state = np.array([MISSING if field not in a else (NONE if a[field] is None else PRESENT) for a in activities],
+                         dtype=np.uint8)
+        kind = _column_kind(values)
+        if kind in ('i', 'f', 'b'):
+            dtype = {'i': np.int64, 'f': np.float64, 'b': np.uint8}[kind]
+            arrays = {'values': np.array([0 if v is None else v for v in values], dtype=dtype)}
+        elif kind == 's':
+            arrays = _encode_blob(values, lambda v: v.encode('utf-8'))
+        else:
+            arrays = _encode_blob(values, lambda v: json.dumps(v).encode('utf-8'))
+        arrays['state'] = state
+        columns[field] = (kind, arrays)
+    return columns
+
+
+def _layout(columns):
+    # Place every array at an 8 byte aligned offset of one buffer
+    layout = []
+    size = 0
+    for field in sorted(columns):
+        kind, arrays = columns[field]
+        specs = {}
+        for name, array in arrays.items():
+            specs[name] = (array.dtype.str, size, len(array))
+            size += (array.nbytes + 7) // 8 * 8
+        layout.append((field, kind, specs))
+    return layout, max(size, 8)
+
+
+def _views(buf, layout):
+    result = []
+    for field, kind, specs in layout:
+        arrays = dict([(name, np.frombuffer(buf, dtype=np.dtype(dtype), count=count, offset=offset))
+                       for name, (dtype, offset, count) in specs.items()])
+        result.append((field, kind, arrays))
+    return result
+
+
+def _decode(kind, arrays, first, last):
+    # Values for rows first..last as Python objects
+    if kind in ('i', 'f', 'b'):
+        values = arrays['values'][first:last].tolist()
+        return [bool(v) for v in values] if kind == 'b' else values
+
+    offsets = arrays['offsets'][first:last + 1].tolist()
+    blob = arrays['blob']
+    values = []
+    for start, end in zip(offsets, offsets[1:]):
+        data = blob[start:end].tobytes().decode('utf-8')
+        values.append(data if kind == 's' else (json.loads(data) if data else None))
+    return values
+
+
+def iter_activities(views, count, chunk_size=1000):
+    """Rebuild the activities from column views a chunk at a time"""
+    for first in range(0, count, chunk_size):
+        last = min(count, first + chunk_size)
+        chunk = [{} for i in range(last - first)]
+        for field, kind, arrays in views:
+            states = arrays['state'][first:last].tolist()
+            for activity, state, value in zip(chunk, states, _decode(kind, arrays, first, last)):
+                if state == PRESENT:
+                    activity[field] = value
+                elif state == NONE:
+                    activity[field] = None
+        yield chunk
+
+
+def partition(collection, parts):
+    """Split the badge IDs of a collection into at most parts lists
+
+    Badges sharing an accumulator stay together so its metric is only
+    computed by one worker.
+    """
+    groups = {}
+    for series in collection._series:
+        for badge_id, badge in series._badges.items():
+            if badge.accumulator is None:
+                key = badge_id
+            else:
+                key = (series.start_date, badge.accumulator)
+            groups.setdefault(key, []).append(badge_id)
+
+    result = [[] for i in range(min(parts, len(groups)))]
+    for idx, group in enumerate(sorted(groups.values())):
+        result[idx % len(result)].extend(group)
+    return result
+
+
+def _init_worker(handle, layout, count, kwargs):
+    if shared_memory is not None:
+        shm = shared_memory.SharedMemory(name=handle)
+        _worker['shm'] = shm
+        buf = shm.buf
+    else:
+        buf = handle
+    _worker['views'] = _views(buf, layout)
+    _worker['count'] = count
+    _worker['kwargs'] = kwargs
+
+
+def _evaluate(badge_ids):
+    kwargs = dict(_worker['kwargs'])
+    kwargs['id_filter'] = badge_ids
+    collection = BadgeCollection(**kwargs)
+    before = set([b.id for b in collection.acquired_badges])
+    for chunk in iter_activities(_worker['views'], _worker['count']):
+        for e in collection.add_activities(chunk):
+            pass
+    return [(b.id, b.activityId, b.actualEarnedDate) for b in collection.acquired_badges if b.id not in before]
+
+
+def add_activities(kwargs, collection, activities, processes=None):
+    """Add activities to collection using a pool of processes
+
+    kwargs are the BadgeCollection arguments collection was built from.
+    Only which badges were acquired (and when) is merged back, so this is
+    meant for evaluating a complete history in one go; activities can't be
+    added incrementally afterwards. Returns the BadgeEarned events sorted
+    by date and badge ID.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    decorated = sorted([(sru.get_start_time(a), idx, a) for idx, a in enumerate(activities)])
+    columns = to_columns([x[2] for x in decorated])
+    layout, size = _layout(columns)
+
+    if shared_memory is not None:
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        buf, handle = shm.buf, shm.name
+    else:
+        shm = None
+        handle = RawArray('B', size)
+        buf = handle
+
+    parts = partition(collection, processes)
+    logging.info("Evaluating %d activities across %d processes" % (len(decorated), len(parts)))
+    pool = None
+    try:
+        for field, kind, specs in layout:
+            for name, (dtype, offset, count) in specs.items():
+                target = np.frombuffer(buf, dtype=np.dtype(dtype), count=count, offset=offset)
+                target[:] = columns[field][1][name]
+                del target
+        del columns
+
+        pool = multiprocessing.Pool(processes=len(parts), initializer=_init_worker,
+                                    initargs=(handle, layout, len(decorated), kwargs))
+        results = pool.map(_evaluate, parts, chunksize=1)
+        pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    events = []
+    for badge_id, activity_id, date in [r for result in results for r in result]:
+        badge = collection.get_badge(badge_id)
+        if not badge.acquired:
+            badge.activityId = activity_id
+            badge.actualEarnedDate = date
+            events.append(BadgeEarned(badge_id, activity_id, date))
+    return sorted(events, key=lambda e: (e.date, e.badge_id))
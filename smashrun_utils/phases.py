@@ -0,0 +1,259 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+# Wall time, CPU time and memory per phase of a run (loading, sorting,
+# evaluating, writing) so a slow or memory hungry run can be blamed on a
+# phase without a profiler. Nothing is recorded until enable() is called;
+# until then phase() costs a function call. Phases may nest and may be
+# entered many times (e.g. once per batch); the summary adds up every span
+# of a phase and the trace keeps each one.
+#
+# Memory comes from tracemalloc and only covers allocations made by Python
+# after enable(memory=True). The peak is the most memory traced at any point
+# during the phase and net is what the phase left allocated. Before Python
+# 3.9 the peak can't be reset per phase, so the process' resident set size
+# is used instead: the peak is the most the process had resident by the end
+# of the phase and net is how much its resident set grew during it.
+
+_recorder = None
+
+
+class Span(object):
+    def __init__(self, name, depth, start, cpu, memory):
+        self.name = name
+        self.thread = threading.current_thread().ident
+        self.depth = depth
+        self.start = start
+        self.cpu = cpu
+        self.memory = memory
+        self.peak = memory
+        self.elapsed = None
+        self.cpu_elapsed = None
+        self.net = None
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _max_rss():
+    # ru_maxrss is in kilobytes, except on macOS where it's bytes
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _rss():
+    # The current resident set size, where /proc has it
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class Recorder(object):
+    def __init__(self, memory=False):
+        # Peaks can only be measured per phase where the peak can be reset
+        self.memory = memory and tracemalloc is not None and hasattr(tracemalloc, 'reset_peak')
+        # Otherwise fall back to the resident set size of the process
+        self.rss = memory and not self.memory and resource is not None
+        if memory and not self.memory:
+            if self.rss:
+                logging.info("tracemalloc can't reset its peak before Python 3.9; measuring phase memory as resident set size")
+            else:
+                logging.warning("No way to measure phase memory here; only timing phases")
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.started = time.time()
+        self.spans = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _traced(self):
+        # Fold the peak so far into the enclosing span before restarting it
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self._stack()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def begin(self, name):
+        stack = self._stack()
+        if self.memory:
+            memory = self._traced()
+        elif self.rss:
+            memory = _rss()
+        else:
+            memory = None
+        span = Span(name, len(stack), time.time(), _cpu_time(), memory)
+        stack.append(span)
+        return span
+
+    def end(self, span):
+        stack = self._stack()
+        span.elapsed = time.time() - span.start
+        span.cpu_elapsed = _cpu_time() - span.cpu
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            span.peak = max(span.peak, peak)
+            span.net = current - span.memory
+        elif self.rss:
+            span.peak = _max_rss()
+            current = _rss()
+            span.net = current - span.memory if current is not None and span.memory is not None else None
+        stack.pop()
+        if stack and self.memory:
+            stack[-1].peak = max(stack[-1].peak, span.peak)
+        with self._lock:
+            self.spans.append(span)
+
+    def totals(self):
+        """Return [(name, depth, calls, wall, cpu, peak, net)] in the order phases first started"""
+        totals = {}
+        order = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            if span.name not in totals:
+                totals[span.name] = [span.name, span.depth, 0, 0.0, 0.0, None, None]
+                order.append(span.name)
+            entry = totals[span.name]
+            entry[2] += 1
+            entry[3] += span.elapsed
+            entry[4] += span.cpu_elapsed
+            if span.peak is not None:
+                entry[5] = max(entry[5], span.peak) if entry[5] is not None else span.peak
+            if span.net is not None:
+                entry[6] = (entry[6] or 0) + span.net
+        return [tuple(totals[name]) for name in order]
+
+    def trace(self):
+        """Return the spans as a Chrome trace (chrome://tracing, Perfetto)"""
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            args = {'cpu_ms': round(span.cpu_elapsed * 1000, 3)}
+            if span.peak is not None:
+                args['peak_bytes'] = span.peak
+            if span.net is not None:
+                args['net_bytes'] = span.net
+            events.append({'name': span.name,
+                           'cat': 'phase',
+                           'ph': 'X',
+                           'ts': round((span.start - self.started) * 1e6, 1),
+                           'dur': round(span.elapsed * 1e6, 1),
+                           'pid': os.getpid(),
+                           'tid': span.thread,
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def enable(memory=False):
+    """Start recording phases, with memory figures per phase if memory"""
+    global _recorder
+    _recorder = Recorder(memory)
+    return _recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Record the enclosed block as a span of the phase name"""
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+    span = recorder.begin(name)
+    try:
+        yield
+    finally:
+        recorder.end(span)
+
+
+def iterate(name, iterable):
+    """Yield from iterable, recording the time spent producing each item as name
+
+    The consumer's own work between items isn't counted, so the loading of a
+    lazily read file can be told apart from what is done with it.
+    """
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def _megabytes(value):
+    return '-' if value is None else '%.1f' % (value / 1048576.0)
+
+
+def summary():
+    """Return a table of the recorded phases as a list of lines"""
+    if _recorder is None:
+        return []
+    lines = ['%-24s %6s %10s %10s %9s %9s' % ('phase', 'calls', 'wall (s)', 'cpu (s)', 'peak (MB)', 'net (MB)')]
+    for name, depth, calls, wall, cpu, peak, net in _recorder.totals():
+        lines.append('%-24s %6d %10.3f %10.3f %9s %9s' % ('  ' * depth + name, calls, wall, cpu, _megabytes(peak), _megabytes(net)))
+    return lines
+
+
+def write_trace(filename):
+    """Write the recorded spans as Chrome trace JSON"""
+    with open(filename, 'w') as fh:
+        json.dump(_recorder.trace(), fh)
@@ -0,0 +1,160 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import itertools
+import logging
+import threading
+import metrics
+import utils as sru
+
+# Smashrun lists activities a page at a time, newest to oldest, so badges
+# (which need them oldest first) can't be evaluated until the last page has
+# arrived. Instead the small 'briefs' listing is read first, which says how
+# many pages the full listing has and which activities are on each. Worker
+# threads then fetch the full pages oldest first and a bounded reorder buffer
+# hands them on in order as soon as every older page is in, so badges are
+# evaluated while newer pages are still downloading.
+
+# How long to wait for workers still in a request when the consumer stops
+JOIN_TIMEOUT = 30
+
+
+def ordered_map(func, items, workers=4, window=32):
+    """Yield func(item) for every item, in order, calling func from worker threads
+
+    At most window results are in flight or waiting to be yielded, so a slow
+    item holds back at most window - 1 faster ones. An exception raised by
+    func is re-raised when its result is reached.
+    """
+    items = list(items)
+    results = {}
+    cond = threading.Condition()
+    state = {'next': 0, 'released': 0, 'closed': False}
+
+    def work():
+        while True:
+            with cond:
+                while not state['closed'] and state['next'] < len(items) and state['next'] - state['released'] >= window:
+                    cond.wait()
+                if state['closed'] or state['next'] >= len(items):
+                    return
+                seq = state['next']
+                state['next'] += 1
+
+            try:
+                result = (True, func(items[seq]))
+            except Exception as e:
+                result = (False, e)
+
+            with cond:
+                results[seq] = result
+                cond.notify_all()
+
+    threads = [threading.Thread(target=work, name='fetch-%d' % (i)) for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for seq in range(len(items)):
+            with cond:
+                while seq not in results:
+                    cond.wait()
+                ok, value = results.pop(seq)
+                state['released'] = seq + 1
+                cond.notify_all()
+            if not ok:
+                raise value
+            yield value
+    finally:
+        with cond:
+            state['closed'] = True
+            cond.notify_all()
+        # Don't leave workers mid-request behind an exiting interpreter
+        for thread in threads:
+            thread.join(JOIN_TIMEOUT)
+            if thread.is_alive():
+                logging.warning("%s still busy after %ds" % (thread.name, JOIN_TIMEOUT))
+
+
+def fetch_page(client, since, style, page, count):
+    """Return one page of client.get_activities(count=count, since=since, style=style)"""
+    if getattr(client, 'session', None) is None:
+        # Stand-ins such as stub.StubSmashrun only offer the iterator
+        return list(itertools.islice(client.get_activities(count=count, since=since, style=style),
+                                     page * count, (page + 1) * count))
+
+    # The client only iterates from the first page, so build the request it would make
+    from smashrun.client import to_timestamp
+    parts = ['my', 'activities', 'search'] + ([] if style == 'summary' else [style])
+    params = {'count': count, 'page': page}
+    if since:
+        params['fromDate'] = to_timestamp(since)
+    r = client.session.get(client._build_url(*parts), params=params)
+    r.raise_for_status()
+    return r.json()
+
+_fetch_page = metrics.timed_call('smashrun', 'get_activities_page', fetch_page, retries=2)
+
+
+def list_briefs(client, since):
+    """Return every activity since a date in the 'briefs' style, newest first"""
+    return list(client.get_activities(count=100, since=since, style='briefs'))
+
+_list_briefs = metrics.timed_call('smashrun', 'get_activities_briefs', list_briefs, retries=2)
+
+
+def fetch_activities(client, since, style, fields=None, workers=4, window=8, page_size=20):
+    """Yield the user's activities since a date, oldest first, fetching in the background
+
+    fields prunes each activity as it arrives (see utils.prune_activity).
+    window is the number of pages that may be fetched or buffered at once.
+    """
+    briefs = _list_briefs(client, since)
+    logging.debug("Listed %d activities since %s" % (len(briefs), since))
+    if style == 'briefs':
+        pages = [sorted(briefs, key=sru.get_start_time)]
+    else:
+        ids = [a['activityId'] for a in briefs]
+
+        def load(page):
+            expected = ids[page * page_size:(page + 1) * page_size]
+            found = dict([(a['activityId'], a) for a in _fetch_page(client, since, style, page, page_size)])
+            # Activities uploaded or deleted since the listing shift the pages
+            missing = [x for x in expected if x not in found]
+            if missing:
+                logging.debug("Page %d moved, fetching %d activities individually" % (page, len(missing)))
+                found.update([(x, client.get_activity(x)) for x in missing])
+            return sorted([found[x] for x in expected], key=sru.get_start_time)
+
+        pages = ordered_map(load, reversed(range((len(ids) + page_size - 1) // page_size)), workers, window)
+
+    for page in pages:
+        for activity in page:
+            yield activity if fields is None else sru.prune_activity(activity, fields)
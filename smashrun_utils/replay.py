@@ -0,0 +1,219 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import bisect
+import logging
+import pickle
+import zlib
+import utils as sru
+from badges import BadgeCollection
+from badges import BadgeEarned
+
+
+def pack(collection):
+    return zlib.compress(pickle.dumps(collection, 2))
+
+
+def unpack(data):
+    return pickle.loads(zlib.decompress(data))
+
+
+class BadgeTimeline(object):
+    """A BadgeCollection that accepts activities in any order
+
+    BadgeCollection assumes activities arrive in time order. The timeline
+    keeps every activity it was given, sorted by start time, along with a
+    compressed snapshot of the badge state at the start of each month of
+    activity time. An activity that lands before the latest one (e.g. after a
+    watch failed to sync) only replays history from the nearest earlier
+    snapshot. The same snapshots answer "what was earned as of this date".
+
+    advance_to() brings time based badges (streaks, month ends) up to date
+    without an activity. An activity older than the time advanced to is
+    replayed like a late one, since a streak broken in the meantime may
+    not have been.
+    """
+
+    def __init__(self, **kwargs):
+        self.collection = BadgeCollection(**kwargs)
+        self._keys = []  # (start_date, activityId) in the same order as _activities
+        self._activities = []
+        self._ids = {}  # activityId -> its key in _keys
+        # (position, packed collection, advanced_to) with the state after
+        # adding self._activities[:position] and advancing to advanced_to
+        self.advanced_to = None
+        self._snapshots = [(0, pack(self.collection), None)]
+
+    def __len__(self):
+        return len(self._activities)
+
+    @property
+    def activities(self):
+        return list(self._activities)
+
+    def _earned(self, collection):
+        return dict([(b.id, b) for b in collection.acquired_badges])
+
+    def _append(self, activity, key):
+        # Snapshot every time the activities roll into a new month
+        position = len(self._activities)
+        if position > 0 and sru.is_different_month(self._keys[-1][0], key[0]) and self._snapshots[-1][0] < position:
+            self._snapshots.append((position, pack(self.collection), self.advanced_to))
+
+        self._keys.append(key)
+        self._activities.append(activity)
+        self._ids[key[1]] = key
+        return list(self.collection.add_activities([activity]))
+
+    def add_activity(self, activity):
+        """Add an activity, returning a BadgeEarned for each badge it changed
+
+        An activity with the same ID as one already added replaces it.
+        """
+        return self.add_activities([activity])
+
+    def add_activities(self, activities):
+        """Add activities in any order, returning a BadgeEarned for each badge they changed
+
+        History is replayed at most once, from the earliest activity that
+        lands before the latest one already added or replaces one.
+        """
+        decorated = sorted([((sru.get_start_time(a), a['activityId']), idx, a) for idx, a in enumerate(activities)])
+        count = len(self._activities)
+        position = count
+        date = None
+        for key, idx, activity in decorated:
+            replaced = self._ids.pop(key[1], None)
+            if replaced is not None:
+                logging.debug("Replacing activity ID=%s" % (key[1]))
+                at = bisect.bisect_left(self._keys, replaced)
+                del self._keys[at]
+                del self._activities[at]
+                if at < count:
+                    count -= 1
+                    position = min(position, at)
+                    date = replaced[0] if date is None else min(date, replaced[0])
+
+            insert_at = bisect.bisect_right(self._keys, key)
+            late = self.advanced_to is not None and key[0] < self.advanced_to
+            if insert_at < count or late:
+                position = min(position, insert_at)
+                date = key[0] if date is None else min(date, key[0])
+            if insert_at < count:
+                # Before some of what was already there
+                count += 1
+            self._keys.insert(insert_at, key)
+            self._activities.insert(insert_at, activity)
+            self._ids[key[1]] = key
+
+        if date is not None:
+            return self._replay(position, date)
+
+        # Everything landed after what was already there
+        keys = self._keys[count:]
+        added = self._activities[count:]
+        del self._keys[count:]
+        del self._activities[count:]
+        events = []
+        for key, activity in zip(keys, added):
+            events.extend(self._append(activity, key))
+        return events
+
+    def advance_to(self, when):
+        """Bring time based badges up to date as of when, returning a BadgeEarned for each earned"""
+        if self.advanced_to is not None and when <= self.advanced_to:
+            return []
+        self.advanced_to = when
+        return self.collection.advance_to(when)
+
+    def _replay(self, position, date):
+        before = self._earned(self.collection)
+
+        # Only snapshots taken before position, and before any advance past
+        # date, are still valid
+        while self._snapshots[-1][0] > position or (self._snapshots[-1][2] is not None and self._snapshots[-1][2] > date):
+            self._snapshots.pop()
+        first, data, advanced_to = self._snapshots[-1]
+        logging.debug("Replaying %d of %d activities" % (len(self._activities) - first, len(self._activities)))
+
+        self.collection = unpack(data)
+        keys = self._keys[first:]
+        activities = self._activities[first:]
+        del self._keys[first:]
+        del self._activities[first:]
+        for key, activity in zip(keys, activities):
+            self._append(activity, key)
+        if self.advanced_to is not None:
+            self.collection.advance_to(self.advanced_to)
+
+        after = self._earned(self.collection)
+        for badge_id in before:
+            if badge_id not in after:
+                logging.info("%s: no longer earned" % (before[badge_id].name))
+
+        events = []
+        for badge_id, badge in after.items():
+            if badge_id not in before or before[badge_id].activityId != badge.activityId:
+                events.append(BadgeEarned(badge_id, badge.activityId, badge.actualEarnedDate))
+        return sorted(events, key=lambda x: x.date)
+
+    def collection_as_of(self, date):
+        """Return a new BadgeCollection holding the state as of date"""
+        end = bisect.bisect_right([k[0] for k in self._keys], date)
+        idx = bisect.bisect_right([s[0] for s in self._snapshots], end) - 1
+        while self._snapshots[idx][2] is not None and self._snapshots[idx][2] > date:
+            idx -= 1
+        first, data, advanced_to = self._snapshots[idx]
+
+        collection = unpack(data)
+        for e in collection.add_activities(self._activities[first:end]):
+            pass
+        collection.advance_to(date)
+        return collection
+
+    def earned_as_of(self, date):
+        """Return the badges that had been earned as of date"""
+        return [b for b in self.collection_as_of(date).acquired_badges if b.actualEarnedDate <= date]
+
+    def save(self, filename):
+        with open(filename, 'wb') as fh:
+            pickle.dump((self._keys, self._activities, self._snapshots, pack(self.collection), self.advanced_to), fh, 2)
+
+    @classmethod
+    def load(cls, filename):
+        timeline = cls.__new__(cls)
+        with open(filename, 'rb') as fh:
+            saved = pickle.load(fh)
+        (timeline._keys, timeline._activities, timeline._snapshots, data) = saved[:4]
+        timeline.advanced_to = saved[4] if len(saved) > 4 else None
+        # Files saved before advance_to() existed have no advanced_to in their snapshots
+        timeline._snapshots = [(x + (None,))[:3] for x in timeline._snapshots]
+        timeline._ids = dict([(k[1], k) for k in timeline._keys])
+        timeline.collection = unpack(data)
+        return timeline
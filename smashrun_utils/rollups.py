@@ -0,0 +1,224 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import collections
+import datetime
+import logging
+import sqlite3
+import utils as sru
+
+# Day, ISO week, month and year totals of runs, distance, time and climb,
+# kept in SQLite and updated as activities are added, so reports never
+# rescan the activities themselves. Each activity leaves a small row in
+# 'activities' so adding it again (or a corrected version, e.g. after
+# sr-fixdates moved it to another day) only applies the difference.
+# Streaks of consecutive days with a run are kept as (first, last) day
+# ordinals and merged or split as days gain their first run or lose their
+# last one.
+
+RESOLUTIONS = ('day', 'week', 'month', 'year')
+
+# What each activity contributes, from the fields sr-badgecalc already uses
+FIELDS = ['activityId', 'startDateTimeLocal', 'distance', 'duration', 'elevationGain', 'isTreadmill',
+          'recordingKeys', 'recordingValues']
+
+Totals = collections.namedtuple('Totals', ['period', 'runs', 'distance', 'duration', 'elevation'])
+Streak = collections.namedtuple('Streak', ['first', 'last', 'days'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    activity_id INTEGER PRIMARY KEY,
+    day INTEGER NOT NULL,
+    distance REAL NOT NULL,
+    duration REAL NOT NULL,
+    elevation REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    resolution TEXT NOT NULL,
+    period TEXT NOT NULL,
+    runs INTEGER NOT NULL,
+    distance REAL NOT NULL,
+    duration REAL NOT NULL,
+    elevation REAL NOT NULL,
+    PRIMARY KEY (resolution, period)
+);
+CREATE TABLE IF NOT EXISTS streaks (
+    first INTEGER PRIMARY KEY,
+    last INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS streaks_last ON streaks (last);
+"""
+
+
+def periods(day):
+    """Return the period keys of a local day ordinal at each resolution"""
+    date = datetime.date.fromordinal(day)
+    iso = date.isocalendar()
+    return (('day', date.strftime('%Y-%m-%d')),
+            ('week', '%04d-W%02d' % (iso[0], iso[1])),
+            ('month', date.strftime('%Y-%m')),
+            ('year', date.strftime('%Y')))
+
+
+def period_of(resolution, date):
+    """Return the period key holding date at resolution"""
+    return dict(periods(date.toordinal()))[resolution]
+
+
+def summarize(activity):
+    """Return (day ordinal, km, seconds, meters) for an activity"""
+    day = sru.get_start_time(activity).date().toordinal()
+    return (day,
+            sru.get_distance(activity).to(sru.UNITS.kilometer).magnitude,
+            sru.get_duration(activity).to(sru.UNITS.seconds).magnitude,
+            sru.elevation_gain(activity).to(sru.UNITS.meters).magnitude)
+
+
+class Rollups(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = sqlite3.connect(filename)
+        self._db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def add_activities(self, activities):
+        """Fold activities into the rollups, returning (added, changed) counts
+
+        Activities already added with the same day and totals are skipped.
+        Everything is committed at once.
+        """
+        added = changed = 0
+        with self._db:
+            for activity in activities:
+                summary = summarize(activity)
+                row = self._db.execute('SELECT day, distance, duration, elevation FROM activities WHERE activity_id = ?',
+                                       (activity['activityId'],)).fetchone()
+                if row is not None:
+                    if tuple(row) == summary:
+                        continue
+                    self._apply(row, -1)
+                    changed += 1
+                else:
+                    added += 1
+                self._db.execute('INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?)', (activity['activityId'],) + summary)
+                self._apply(summary, 1)
+        logging.debug("Rollups: %d activities added, %d changed" % (added, changed))
+        return added, changed
+
+    def remove_activity(self, activity_id):
+        """Take an activity back out of the rollups, returning whether it was there"""
+        with self._db:
+            row = self._db.execute('SELECT day, distance, duration, elevation FROM activities WHERE activity_id = ?',
+                                   (activity_id,)).fetchone()
+            if row is None:
+                return False
+            self._db.execute('DELETE FROM activities WHERE activity_id = ?', (activity_id,))
+            self._apply(row, -1)
+        return True
+
+    def _apply(self, summary, sign):
+        day, distance, duration, elevation = summary
+        for resolution, period in periods(day):
+            self._db.execute('INSERT OR IGNORE INTO rollups VALUES (?, ?, 0, 0, 0, 0)', (resolution, period))
+            self._db.execute('UPDATE rollups SET runs = runs + ?, distance = distance + ?, duration = duration + ?, '
+                             'elevation = elevation + ? WHERE resolution = ? AND period = ?',
+                             (sign, sign * distance, sign * duration, sign * elevation, resolution, period))
+        runs = self._db.execute('SELECT runs FROM rollups WHERE resolution = ? AND period = ?', periods(day)[0]).fetchone()[0]
+        if sign < 0:
+            # Periods left without runs are dropped rather than kept as zeros
+            for resolution, period in periods(day):
+                self._db.execute('DELETE FROM rollups WHERE resolution = ? AND period = ? AND runs = 0', (resolution, period))
+        if sign > 0 and runs == 1:
+            self._add_day(day)
+        elif sign < 0 and runs == 0:
+            self._remove_day(day)
+
+    def _add_day(self, day):
+        before = self._db.execute('SELECT first FROM streaks WHERE last = ?', (day - 1,)).fetchone()
+        after = self._db.execute('SELECT last FROM streaks WHERE first = ?', (day + 1,)).fetchone()
+        first = before[0] if before is not None else day
+        last = after[0] if after is not None else day
+        if after is not None:
+            self._db.execute('DELETE FROM streaks WHERE first = ?', (day + 1,))
+        self._db.execute('INSERT OR REPLACE INTO streaks VALUES (?, ?)', (first, last))
+
+    def _remove_day(self, day):
+        row = self._db.execute('SELECT first, last FROM streaks WHERE first <= ? AND last >= ?', (day, day)).fetchone()
+        if row is None:
+            return
+        first, last = row
+        self._db.execute('DELETE FROM streaks WHERE first = ?', (first,))
+        if first < day:
+            self._db.execute('INSERT INTO streaks VALUES (?, ?)', (first, day - 1))
+        if last > day:
+            self._db.execute('INSERT INTO streaks VALUES (?, ?)', (day + 1, last))
+
+    def totals(self, resolution, start=None, stop=None):
+        """Return Totals for each period with a run at resolution, oldest first
+
+        start and stop are dates; periods holding them are included. Distance
+        is in kilometers, duration in seconds and elevation in meters.
+        """
+        if resolution not in RESOLUTIONS:
+            raise ValueError("Unknown resolution %s" % (resolution))
+        query = 'SELECT period, runs, distance, duration, elevation FROM rollups WHERE resolution = ?'
+        params = [resolution]
+        if start is not None:
+            query += ' AND period >= ?'
+            params.append(period_of(resolution, start))
+        if stop is not None:
+            query += ' AND period <= ?'
+            params.append(period_of(resolution, stop))
+        return [Totals(*row) for row in self._db.execute(query + ' ORDER BY period', params)]
+
+    def streaks(self, limit=5):
+        """Return the longest streaks of days with a run, longest (then latest) first"""
+        rows = self._db.execute('SELECT first, last FROM streaks ORDER BY last - first DESC, last DESC LIMIT ?', (limit,))
+        return [self._streak(first, last) for first, last in rows]
+
+    def current_streak(self, today):
+        """Return the streak that ends today or yesterday (so can still be extended), or None"""
+        row = self._db.execute('SELECT first, last FROM streaks WHERE last >= ?', (today.toordinal() - 1,)).fetchone()
+        return self._streak(*row) if row is not None else None
+
+    def _streak(self, first, last):
+        return Streak(datetime.date.fromordinal(first), datetime.date.fromordinal(last), last - first + 1)
+
+    def latest_day(self):
+        """Return the date of the most recent run added, or None"""
+        row = self._db.execute("SELECT MAX(day) FROM activities").fetchone()
+        return datetime.date.fromordinal(row[0]) if row[0] is not None else None
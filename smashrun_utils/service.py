@@ -0,0 +1,305 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+import batch as srbatch
+import metrics
+from deadlines import DeadlineHeap
+from replay import BadgeTimeline
+from dateutil.tz import tzutc
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen
+
+
+class BadgeService(object):
+    """Keeps a warm BadgeTimeline per user and feeds new activities into it
+
+    Each user's timeline is built (or reloaded from state_dir) on first use
+    and kept in memory, so a new activity only costs one incremental update
+    rather than a recalculation over the user's whole history. Users are
+    locked independently so one user's backfill doesn't stall the others.
+    client_factory(user) must return a Smashrun client; it is only needed for
+    webhook notifications that carry just an activity ID.
+
+    Users are also kept in a heap by the next time one of their badges
+    changes without an activity (a streak breaking, a month ending), so
+    advance_to() only touches the users whose deadlines have passed.
+    """
+
+    def __init__(self, users, state_dir=None, client_factory=None):
+        self.users = dict([(u['name'], u) for u in users])
+        self.state_dir = state_dir
+        self.client_factory = client_factory
+        self._timelines = {}
+        self._locks = dict([(name, threading.Lock()) for name in self.users])
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._deadlines = DeadlineHeap()
+
+    def _state_file(self, name):
+        return os.path.join(self.state_dir, '%s.timeline' % (name))
+
+    def _timeline(self, name):
+        # Caller must hold the user's lock
+        if name in self._timelines:
+            return self._timelines[name]
+
+        user = self.users[name]
+        timeline = None
+        if self.state_dir is not None and os.path.isfile(self._state_file(name)):
+            try:
+                timeline = BadgeTimeline.load(self._state_file(name))
+                logging.info("%s: restored %d activities from %s" % (name, len(timeline), self._state_file(name)))
+            except Exception:
+                logging.exception("%s: unable to restore state, rebuilding" % (name))
+
+        if timeline is None:
+            start_time = time.time()
+            timeline = BadgeTimeline(**srbatch.collection_args(user))
+            timeline.add_activities(srbatch.load_activities(user))
+            logging.info("%s: built from %d activities in %.2fs" % (name, len(timeline), time.time() - start_time))
+            self._mark_dirty(name)
+
+        self._timelines[name] = timeline
+        self._deadlines.schedule(name, timeline.collection.deadline())
+        return timeline
+
+    def _mark_dirty(self, name):
+        with self._dirty_lock:
+            self._dirty.add(name)
+
+    def warm(self):
+        """Build or restore every user's timeline up front"""
+        for name in self.users:
+            with self._locks[name]:
+                self._timeline(name)
+
+    def _event_to_dict(self, timeline, event):
+        result = srbatch.badge_to_dict(timeline.collection.get_badge(event.badge_id))
+        result['activityId'] = event.activity_id
+        result['actualEarnedDate'] = event.date.isoformat()
+        return result
+
+    def add_activities(self, name, activities):
+        """Add activities for a user, returning the badges they earned"""
+        with self._locks[name]:
+            timeline = self._timeline(name)
+            # Added together so a newest first batch replays history once
+            earned = [self._event_to_dict(timeline, e) for e in timeline.add_activities(activities)]
+            self._deadlines.schedule(name, timeline.collection.deadline())
+        self._mark_dirty(name)
+        return earned
+
+    def advance_to(self, when):
+        """Bring time based badges up to date for users with a deadline before when
+
+        Returns {name: [badges earned]} for the users that were touched.
+        """
+        touched = {}
+        for name in self._deadlines.pop_due(when):
+            with self._locks[name]:
+                timeline = self._timeline(name)
+                touched[name] = [self._event_to_dict(timeline, e) for e in timeline.advance_to(when)]
+                self._deadlines.schedule(name, timeline.collection.deadline())
+            self._mark_dirty(name)
+            for badge in touched[name]:
+                logging.info("%s: earned %s on %s" % (name, badge['name'], badge['actualEarnedDate']))
+        if touched:
+            logging.debug("Advanced %d of %d users to %s" % (len(touched), len(self._timelines), when))
+        return touched
+
+    def fetch_activity(self, name, activity_id):
+        """Fetch an activity from Smashrun and add it"""
+        if self.client_factory is None:
+            raise RuntimeError("No Smashrun client configured to fetch activity ID=%s" % (activity_id))
+        activity = self.client_factory(self.users[name]).get_activity(activity_id)
+        return self.add_activities(name, [activity])
+
+    def earned(self, name):
+        with self._locks[name]:
+            return [srbatch.badge_to_dict(b) for b in self._timeline(name).collection.acquired_badges]
+
+    def save(self):
+        """Write out the timeline of every user that changed since the last save"""
+        if self.state_dir is None:
+            return
+        with self._dirty_lock:
+            dirty = self._dirty
+            self._dirty = set()
+
+        for name in dirty:
+            filename = self._state_file(name)
+            with self._locks[name]:
+                # Write to the side and rename so a crash never leaves a
+                # partial state file behind
+                self._timelines[name].save(filename + '.tmp')
+                os.rename(filename + '.tmp', filename)
+            logging.debug("%s: saved state to %s" % (name, filename))
+
+    def start_clock(self, interval):
+        """Call advance_to() with the current time every interval seconds from a daemon thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.advance_to(datetime.datetime.now(tzutc()))
+                except Exception:
+                    logging.exception("Unable to advance badge state")
+
+        thread = threading.Thread(target=run, name='badge-clock')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def start_saver(self, interval):
+        """Save dirty state every interval seconds from a daemon thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save()
+                except Exception:
+                    logging.exception("Unable to save service state")
+
+        thread = threading.Thread(target=run, name='badge-saver')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class BadgeRequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end for BadgeService
+
+    POST /users/<name>/activities   body: an activity or a list of activities
+    POST /users/<name>/webhook      body: {"activityId": N}
+    GET  /users/<name>/badges
+    GET  /metrics                   OpenMetrics text exposition
+    """
+
+    path_re = re.compile(r'^/users/([^/]+)/(activities|webhook|badges)/?$')
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s" % (self.address_string(), format % args))
+
+    def _reply(self, status, body):
+        data = json.dumps(body, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method):
+        match = self.path_re.match(self.path.split('?')[0])
+        if match is None:
+            return None, None
+        name, action = match.groups()
+        if name not in self.server.service.users:
+            return None, None
+        if (method == 'GET') != (action == 'badges'):
+            return None, None
+        return name, action
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            data = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            return self.wfile.write(data)
+
+        name, action = self._route('GET')
+        if name is None:
+            return self._reply(404, {'error': 'Not found: %s' % (self.path)})
+        self._reply(200, {'badges': self.server.service.earned(name)})
+
+    def do_POST(self):
+        name, action = self._route('POST')
+        if name is None:
+            return self._reply(404, {'error': 'Not found: %s' % (self.path)})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as e:
+            return self._reply(400, {'error': 'Invalid JSON: %s' % (e)})
+
+        try:
+            if action == 'webhook':
+                earned = self.server.service.fetch_activity(name, body['activityId'])
+            else:
+                earned = self.server.service.add_activities(name, body if isinstance(body, list) else [body])
+        except (KeyError, TypeError) as e:
+            return self._reply(400, {'error': 'Invalid activity: %s' % (e)})
+        except Exception as e:
+            logging.exception("%s: unable to process %s" % (name, self.path))
+            return self._reply(500, {'error': str(e)})
+        self._reply(200, {'earned': earned})
+
+
+class BadgeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, BadgeRequestHandler)
+        self.service = service
+
+
+def run_loadtest(url, name, activities):
+    """POST activities one at a time and return latency statistics in ms"""
+    latencies = []
+    start_time = time.time()
+    for activity in activities:
+        request = Request('%s/users/%s/activities' % (url, name),
+                          data=json.dumps(activity).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        t0 = time.time()
+        urlopen(request).read()
+        latencies.append((time.time() - t0) * 1000.0)
+    elapsed = time.time() - start_time
+
+    return {'requests': len(latencies),
+            'p50': metrics.percentile(latencies, 50),
+            'p99': metrics.percentile(latencies, 99),
+            'max': max(latencies),
+            'throughput': len(latencies) / elapsed if elapsed > 0 else 0.0}
@@ -0,0 +1,219 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import collections
+import logging
+import time
+import utils as sru
+from badges import BadgeCollection
+from badges import RunStreakBadge
+
+# Shadow mode runs one or more candidate engines over the same activities
+# as the reference BadgeCollection and reports every badge where they
+# disagree on whether it was acquired, the activity that earned it or
+# actualEarnedDate, along with how long each took.
+#
+# An engine is a function engine(kwargs, activities) returning
+# {badge_id: (activityId, actualEarnedDate)} for every acquired badge.
+# kwargs are the BadgeCollection arguments and activities may be in any
+# order. Engines are registered in ENGINES by name.
+
+ENGINES = collections.OrderedDict()
+
+# One badge the engines disagree on. reference and candidate are
+# (activityId, actualEarnedDate) or None when the badge wasn't acquired.
+Mismatch = collections.namedtuple('Mismatch', ['badge_id', 'name', 'reference', 'candidate'])
+
+
+def engine(name):
+    """Decorator registering an engine function under name"""
+    def register(func):
+        ENGINES[name] = func
+        return func
+    return register
+
+
+def _acquired(collection):
+    return dict([(b.id, (b.activityId, b.actualEarnedDate)) for b in collection.badges if b.acquired])
+
+
+def _sorted(activities):
+    decorated = sorted([(sru.get_start_time(a), idx, a) for idx, a in enumerate(activities)])
+    return [x[2] for x in decorated]
+
+
+def _chunks(activities, size=100):
+    for idx in range(0, len(activities), size):
+        yield activities[idx:idx + size]
+
+
+@engine('reference')
+def reference(kwargs, activities):
+    """One activity at a time through BadgeCollection.add_activity()"""
+    collection = BadgeCollection(**kwargs)
+    for activity in _sorted(activities):
+        collection.add_activity(activity)
+    return _acquired(collection)
+
+
+@engine('batched')
+def batched(kwargs, activities):
+    """BadgeCollection.add_activities() a page of 100 at a time, as sr-badgecalc does"""
+    collection = BadgeCollection(**kwargs)
+    for chunk in _chunks(_sorted(activities)):
+        for e in collection.add_activities(chunk):
+            pass
+    return _acquired(collection)
+
+
+@engine('packed')
+def packed(kwargs, activities):
+    """Packed per-user state, unpacked and packed again around each page of 100"""
+    from packed import UserStates
+    states = UserStates()
+    states.add_user('shadow', **kwargs)
+    for chunk in _chunks(_sorted(activities)):
+        states.add_activities('shadow', chunk)
+    return dict([(e.badge_id, (e.activity_id, e.date)) for e in states.earned('shadow')])
+
+
+@engine('timeline')
+def timeline(kwargs, activities):
+    """BadgeTimeline, given the activities in one add_activities() call
+
+    The timeline sorts them itself, so this costs no replays whatever order
+    they were passed in.
+    """
+    from replay import BadgeTimeline
+    result = BadgeTimeline(**kwargs)
+    result.add_activities(activities)
+    return _acquired(result.collection)
+
+
+@engine('parallel')
+def parallel(kwargs, activities):
+    """Badges split across processes over shared memory columns (needs numpy)"""
+    import parallel as srparallel
+    collection = BadgeCollection(**kwargs)
+    srparallel.add_activities(kwargs, collection, activities)
+    return _acquired(collection)
+
+
+@engine('streaks')
+def streaks(kwargs, activities):
+    """RunStreakBadges from arrays of run times, everything else batched (needs numpy)"""
+    import streaks as srstreaks
+    collection = BadgeCollection(**kwargs)
+    for series in collection._series:
+        series._activity_badges = [b for b in series._activity_badges if not isinstance(b, RunStreakBadge)]
+    for chunk in _chunks(_sorted(activities)):
+        for e in collection.add_activities(chunk):
+            pass
+    srstreaks.add_activities(collection, activities)
+    return _acquired(collection)
+
+
+def diff(collection, expected, actual):
+    """Return a Mismatch for each badge where expected and actual differ"""
+    mismatches = []
+    for badge_id in sorted(set(expected) | set(actual)):
+        if expected.get(badge_id) != actual.get(badge_id):
+            badge = collection.get_badge(badge_id)
+            name = badge.name if badge is not None else str(badge_id)
+            mismatches.append(Mismatch(badge_id, name, expected.get(badge_id), actual.get(badge_id)))
+    return mismatches
+
+
+class ShadowReport(object):
+    """The outcome of compare_engines()
+
+    elapsed maps each engine (including 'reference') to its wall time in
+    seconds and mismatches maps each candidate to its list of Mismatch.
+    """
+
+    def __init__(self, activities):
+        self.activities = activities
+        self.elapsed = collections.OrderedDict()
+        self.mismatches = collections.OrderedDict()
+
+    @property
+    def ok(self):
+        return not any(self.mismatches.values())
+
+    def speedup(self, name):
+        """How many times faster than the reference name was"""
+        elapsed = self.elapsed[name]
+        return self.elapsed['reference'] / elapsed if elapsed > 0 else float('inf')
+
+    def lines(self):
+        """Return a human readable summary, one line per entry"""
+        result = ["%-10s %8.3fs  %d activities" % ('reference', self.elapsed['reference'], self.activities)]
+        for name, mismatches in self.mismatches.items():
+            result.append("%-10s %8.3fs  %5.2fx  %s" % (name, self.elapsed[name], self.speedup(name),
+                                                        'OK' if not mismatches else '%d MISMATCHES' % (len(mismatches))))
+            for m in mismatches:
+                result.append("    %s (%d): reference=%s %s=%s" % (m.name, m.badge_id, _format(m.reference), name, _format(m.candidate)))
+        return result
+
+
+def _format(value):
+    if value is None:
+        return 'not acquired'
+    return '%s@%s' % (value[0], value[1].isoformat())
+
+
+def compare_engines(kwargs, activities, engines, repeat=1):
+    """Run engines and the reference over activities and compare what they earn
+
+    engines is a list of names from ENGINES or (name, function) pairs.
+    Each engine is timed as the best of repeat runs. Returns a ShadowReport;
+    report.ok is False if any engine disagreed with the reference.
+    """
+    activities = list(activities)
+    # A candidate shares nothing with the reference but its arguments
+    probe = BadgeCollection(**kwargs)
+
+    def timed(func):
+        best = None
+        for idx in range(repeat):
+            start = time.time()
+            result = func(dict(kwargs), activities)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
+
+    report = ShadowReport(len(activities))
+    expected, report.elapsed['reference'] = timed(reference)
+    for entry in engines:
+        name, func = (entry, ENGINES[entry]) if isinstance(entry, str) else entry
+        actual, report.elapsed[name] = timed(func)
+        report.mismatches[name] = diff(probe, expected, actual)
+        if report.mismatches[name]:
+            logging.warning("%s: %d badges differ from the reference" % (name, len(report.mismatches[name])))
+    return report
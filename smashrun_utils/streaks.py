@@ -0,0 +1,222 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import collections
+import datetime
+import dateutil.tz
+import numpy as np
+import utils as sru
+from badges import BadgeEarned
+from badges import RunStreakBadge
+
+# Evaluate every RunStreakBadge from arrays rather than one activity at a
+# time. Badges only differ by days between runs, minimum distance and
+# limit, so the runs that count towards a streak are found once per
+# (days between runs, minimum distance) and every limit is read off them.
+#
+# A qualifying run at or after the start of the day it's next due counts
+# and makes the next run due days_between_runs days after its own day.
+# Runs before that are ignored and a run more than a day after it breaks
+# the streak. Days are local to each run but comparisons are between
+# instants, exactly as RunStreakBadge.increment() makes them, so times are
+# kept as microseconds since the epoch.
+
+DAY = 24 * 60 * 60 * 10 ** 6
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=dateutil.tz.tzutc())
+
+# longest and current are numbers of runs counted (days for daily streaks).
+# first/last are the start times of the runs beginning and ending them.
+# current is 0 once the streak has been broken as of the time asked about.
+StreakStats = collections.namedtuple('StreakStats', ['longest', 'longest_first', 'longest_last', 'current', 'current_first', 'current_last'])
+
+
+def _microseconds(dt):
+    delta = dt - _EPOCH
+    return (delta.days * 24 * 60 * 60 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+class Streak(object):
+    """The runs counted towards one kind of streak
+
+    positions index the activities of the StreakEngine it came from and
+    counts is the streak length after each of them.
+    """
+
+    def __init__(self, engine, positions, counts, days_between_runs):
+        self.engine = engine
+        self.positions = positions
+        self.counts = counts
+        self.days_between_runs = days_between_runs
+        # The longest streak so far after each counted run
+        self._best = np.maximum.accumulate(counts) if len(counts) else counts
+
+    def __len__(self):
+        return len(self.positions)
+
+    def reached(self, limits):
+        """Return the index into positions where each streak length is first
+        reached, or -1 where it never is"""
+        limits = np.asarray(limits)
+        result = np.searchsorted(self._best, limits, side='left')
+        return np.where(result < len(self._best), result, -1)
+
+    def activity(self, idx):
+        return self.engine.activities[self.positions[idx]]
+
+    def next_run(self, idx):
+        """When the run after the idx'th counted run is due, as RunStreakBadge.date_of_next_run"""
+        start = sru.get_start_time(self.activity(idx)) + datetime.timedelta(days=self.days_between_runs)
+        return RunStreakBadge.midnight_of_datetime(start)
+
+    def stats(self, now=None):
+        """Return StreakStats for these runs, as of now if given"""
+        if not len(self):
+            return StreakStats(0, None, None, 0, None, None)
+        longest = int(np.argmax(self.counts))
+        length = int(self.counts[longest])
+        current = len(self) - 1
+        if now is not None and now > self.next_run(current) + datetime.timedelta(days=1):
+            current_length = 0
+            current_first = current_last = None
+        else:
+            current_length = int(self.counts[current])
+            current_first = self._start(current - current_length + 1)
+            current_last = self._start(current)
+        return StreakStats(length, self._start(longest - length + 1), self._start(longest),
+                           current_length, current_first, current_last)
+
+    def _start(self, idx):
+        # A streak carried in from an earlier state began before these runs
+        return sru.get_start_time(self.activity(idx)) if idx >= 0 else None
+
+
+class StreakEngine(object):
+    """Sorted arrays of run times and distances to evaluate streaks from
+
+    activities may be in any order; they're sorted by start time the same
+    way BadgeCollection.add_activities() sorts them.
+    """
+
+    def __init__(self, activities):
+        decorated = sorted([(sru.get_start_time(a), idx, a) for idx, a in enumerate(activities)])
+        self.activities = [x[2] for x in decorated]
+        starts = [x[0] for x in decorated]
+        self.starts = np.array([_microseconds(dt) for dt in starts], dtype=np.int64)
+        # The instant each run's local day began
+        self.midnights = self.starts - np.array([((dt.hour * 60 + dt.minute) * 60 + dt.second) * 10 ** 6 + dt.microsecond
+                                                 for dt in starts], dtype=np.int64)
+        self.distances = np.array([a['distance'] for a in self.activities], dtype=np.float64)
+        self._streaks = {}
+
+    def first_at(self, when):
+        """Index of the first activity starting at or after when"""
+        return int(np.searchsorted(self.starts, _microseconds(when), side='left'))
+
+    def streak(self, days_between_runs=1, min_distance=None, since=None, next_run=None, count=0):
+        """Return the Streak for runs at or after since of at least min_distance
+
+        next_run and count are the state of a RunStreakBadge to carry on from.
+        """
+        floor = None if min_distance is None else min_distance.to(sru.UNITS.kilometer).magnitude
+        key = (days_between_runs, floor, since, next_run, count)
+        result = self._streaks.get(key)
+        if result is None:
+            result = self._streaks[key] = self._streak(*key)
+        return result
+
+    def _streak(self, days_between_runs, floor, since, next_run, count):
+        first = 0 if since is None else self.first_at(since)
+        qualifying = np.arange(first, len(self.starts))
+        if floor is not None:
+            qualifying = qualifying[self.distances[first:] >= floor]
+        starts = self.starts[qualifying]
+        midnights = self.midnights[qualifying]
+
+        # Where the walk goes from each run if it's counted: the first run
+        # on or after the day the next one is due
+        due = midnights + days_between_runs * DAY
+        following = np.searchsorted(starts, due, side='left').tolist()
+        if next_run is None:
+            idx = 0
+        else:
+            idx = int(np.searchsorted(starts, _microseconds(next_run), side='left'))
+        chain = []
+        while idx < len(following):
+            chain.append(idx)
+            idx = following[idx]
+        chain = np.array(chain, dtype=np.int64)
+
+        # A counted run more than a day after the previous one was due
+        # starts a new streak. Run lengths are then distances from the last
+        # break; a streak unbroken since the carried in state adds to count.
+        breaks = np.zeros(len(chain), dtype=bool)
+        if len(chain):
+            breaks[1:] = starts[chain[1:]] > due[chain[:-1]] + DAY
+            if next_run is not None:
+                breaks[0] = starts[chain[0]] > _microseconds(next_run) + DAY
+        steps = np.arange(len(chain))
+        began = np.maximum.accumulate(np.where(breaks, steps, 0)) if len(chain) else steps
+        counts = steps - began + 1
+        if len(chain) and not breaks[0]:
+            counts[np.cumsum(breaks) == 0] += count
+        return Streak(self, qualifying[chain], counts, days_between_runs)
+
+    def stats(self, days_between_runs=1, min_distance=None, now=None):
+        """Return StreakStats over every activity"""
+        return self.streak(days_between_runs, min_distance).stats(now)
+
+
+def add_activities(collection, activities):
+    """Add activities to the RunStreakBadges of collection
+
+    The badges end up in the same state as if the activities were added
+    one at a time in start time order. Every other badge is left alone.
+    Returns the BadgeEarned events sorted by date and badge ID.
+    """
+    engine = StreakEngine(activities)
+    events = []
+    for series in collection._series:
+        for badge in series._badges.values():
+            if not isinstance(badge, RunStreakBadge) or badge.acquired:
+                continue
+            streak = engine.streak(badge.days_between_runs, badge.min_distance, series.start_date,
+                                   badge.date_of_next_run, badge.count)
+            if not len(streak):
+                continue
+            idx = int(streak.reached([badge.limit])[0])
+            last = len(streak) - 1 if idx < 0 else idx
+            badge.count = int(streak.counts[last])
+            badge.date_of_next_run = streak.next_run(last)
+            if idx >= 0:
+                activity = streak.activity(idx)
+                badge.activityId = activity['activityId']
+                badge.actualEarnedDate = sru.get_start_time(activity)
+                events.append(BadgeEarned(badge.id, badge.activityId, badge.actualEarnedDate))
+    return sorted(events, key=lambda e: (e.date, e.badge_id))
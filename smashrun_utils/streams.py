@@ -0,0 +1,351 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import collections
+import json
+import logging
+import os
+import threading
+import numpy as np
+import metrics
+
+# Metrics derived from an activity's recording streams (the 'recordingKeys'
+# and 'recordingValues' returned for detailed activities), used when the
+# summary fields are missing.
+
+EARTH_RADIUS = 6371008.8  # meters
+
+StreamMetrics = collections.namedtuple('StreamMetrics', ['elevation_gain', 'distance', 'moving_time'])
+
+# Most recently used results kept in memory. set_cache_dir() keeps the
+# rest on disk.
+CACHE_SIZE = 4096
+
+_cache = collections.OrderedDict()  # least recently used first
+_cache_lock = threading.Lock()
+_cache_dir = None
+_stats = metrics.cache('streams')
+# The arrays for the most recent activity, so several badges asking about
+# the same activity only convert its recordings once
+_last_streams = (None, None)
+
+
+def set_cache_dir(directory):
+    """Keep computed metrics in directory so later runs skip the work"""
+    global _cache_dir
+    _cache_dir = directory
+
+
+def get_streams(activity):
+    """Return a dictionary of recording key -> float array, or None"""
+    keys = activity.get('recordingKeys')
+    values = activity.get('recordingValues')
+    if not keys or not values:
+        return None
+    streams = dict([(k, np.array(v, dtype=float)) for k, v in zip(keys, values)])
+    if 'latitude' in streams and 'longitude' in streams:
+        # Smashrun marks a point without a GPS fix as (-1, -1)
+        null = (streams['latitude'] == -1) & (streams['longitude'] == -1)
+        streams['latitude'][null] = np.nan
+        streams['longitude'][null] = np.nan
+    return streams
+
+
+def smooth(values, window=5):
+    """Centered moving average that leaves the ends alone"""
+    if window < 2 or len(values) < window:
+        return values
+    result = values.copy()
+    half = window // 2
+    averaged = np.convolve(values, np.ones(window) / window, mode='valid')
+    result[half:half + len(averaged)] = averaged
+    return result
+
+
+def turning_points(values):
+    """Reduce values to its end points and local extrema"""
+    values = values[np.concatenate([[True], np.diff(values) != 0])]
+    if len(values) < 3:
+        return values
+    slope = np.sign(np.diff(values))
+    keep = np.concatenate([[True], slope[1:] != slope[:-1], [True]])
+    return values[keep]
+
+
+def elevation_gain(elevation, threshold=3.0, window=5):
+    """Total climb in the units of elevation, ignoring wiggles under threshold
+
+    A climb only counts once it rises threshold above the lowest point since
+    the last confirmed descent, and ends once it drops threshold below its
+    peak. Only the turning points of the smoothed series are walked.
+    """
+    elevation = elevation[~np.isnan(elevation)]
+    if len(elevation) < 2:
+        return 0.0
+
+    gain = 0.0
+    climbing = False
+    points = turning_points(smooth(elevation, window)).tolist()
+    base = top = points[0]
+    for x in points[1:]:
+        if climbing:
+            if x > top:
+                top = x
+            elif top - x >= threshold:
+                gain += top - base
+                base = top = x
+                climbing = False
+        else:
+            if x < base:
+                base = top = x
+            elif x - base >= threshold:
+                top = x
+                climbing = True
+    if climbing:
+        gain += top - base
+    return gain
+
+
+def _fixes(latitude, longitude):
+    """Mask of the points with a GPS fix"""
+    null = (latitude == -1) & (longitude == -1)
+    return ~(null | np.isnan(latitude) | np.isnan(longitude))
+
+
+def _haversine(latitude, longitude):
+    # Meters between each pair of consecutive points
+    lat = np.radians(latitude)
+    lng = np.radians(longitude)
+    dlat = np.diff(lat)
+    dlng = np.diff(lng)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def segment_distances(latitude, longitude):
+    """Haversine distance in meters between consecutive points
+
+    Points without a fix are dropped. The distance from the last point
+    with a fix is counted in the segment ending at the next one, and
+    segments ending at a point without a fix are 0.
+    """
+    fixes = np.flatnonzero(_fixes(latitude, longitude))
+    result = np.zeros(max(len(latitude) - 1, 0))
+    if len(fixes) > 1:
+        result[fixes[1:] - 1] = _haversine(latitude[fixes], longitude[fixes])
+    return result
+
+
+def moving_time(clock, segments, min_speed=0.5, max_gap=60):
+    """Seconds spent moving faster than min_speed m/s
+
+    Gaps longer than max_gap seconds (e.g. an auto-pause) are never counted.
+    """
+    dt = np.diff(clock)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moving = (dt > 0) & (dt <= max_gap) & (segments / dt >= min_speed)
+    return float(dt[moving].sum())
+
+
+def compute_metrics(streams):
+    """Return StreamMetrics for a dictionary from get_streams()
+
+    Metrics without the streams they need are None.
+    """
+    gain = None
+    if 'elevation' in streams:
+        gain = elevation_gain(streams['elevation'])
+
+    segments = None
+    clock = streams.get('clock')
+    if 'latitude' in streams and 'longitude' in streams:
+        # Only the points with a fix, so a dropout is one segment over its
+        # whole duration
+        fixes = _fixes(streams['latitude'], streams['longitude'])
+        segments = _haversine(streams['latitude'][fixes], streams['longitude'][fixes])
+        if clock is not None:
+            clock = clock[fixes]
+    elif 'distance' in streams:
+        # Smashrun's cumulative distance stream is in kilometers
+        segments = np.nan_to_num(np.diff(streams['distance'])) * 1000.0
+    distance = None if segments is None else float(segments.sum())
+
+    elapsed = None
+    if segments is not None and clock is not None:
+        elapsed = moving_time(clock, segments)
+    return StreamMetrics(gain, distance, elapsed)
+
+
+def cumulative_distance(streams):
+    """Return the distance in meters covered at each sample, or None
+
+    Smashrun's own distance stream is preferred over the GPS track.
+    """
+    if 'distance' in streams:
+        # Kilometers, and never allowed to go backwards
+        distance = np.fmax.accumulate(np.nan_to_num(streams['distance'])) * 1000.0
+    elif 'latitude' in streams and 'longitude' in streams:
+        distance = np.concatenate([[0.0], np.cumsum(segment_distances(streams['latitude'], streams['longitude']))])
+    else:
+        return None
+    return distance
+
+
+def split_times(distance, clock, split_length):
+    """Return the seconds taken for each complete split_length meter split"""
+    count = int(distance[-1] // split_length) if len(distance) else 0
+    if count == 0:
+        return np.zeros(0)
+    # Interpolate the clock at each split boundary
+    boundaries = np.arange(count + 1) * float(split_length)
+    return np.diff(np.interp(boundaries, distance, clock))
+
+
+def max_distance_within(distance, clock, seconds):
+    """Return the most meters covered in any window of at most seconds
+
+    Every sample is treated as the end of a window and a single vectorized
+    searchsorted over the (sorted) clock finds where each window starts,
+    so this is O(n log n) with no Python loop over the samples.
+    """
+    if len(clock) < 2:
+        return 0.0
+    start = np.searchsorted(clock, clock - seconds, side='left')
+    return float(np.max(distance - distance[start]))
+
+
+def min_time_for(distance, clock, meters):
+    """Return the fewest seconds taken to cover meters, or None if never covered"""
+    if len(distance) < 2:
+        return None
+    end = np.searchsorted(distance, distance + meters, side='left')
+    valid = end < len(distance)
+    if not valid.any():
+        return None
+    return float(np.min(clock[end[valid]] - clock[valid]))
+
+
+def compute_splits(streams, split_length):
+    distance = cumulative_distance(streams)
+    if distance is None or 'clock' not in streams:
+        return None
+    return split_times(distance, streams['clock'], split_length)
+
+
+def _cache_key(activity):
+    # Re-uploaded activities keep their ID, so include the shape of the data
+    values = activity['recordingValues']
+    return '%s-%d-%d' % (activity['activityId'], len(values), len(values[0]) if values else 0)
+
+
+def _remember(key, result):
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def _cached(activity, name, compute):
+    """Return compute(streams) for an activity, or None without recordings
+
+    Results must be JSON serializable. They are cached in memory and, after
+    set_cache_dir(), on disk.
+    """
+    if not activity.get('recordingKeys') or not activity.get('recordingValues'):
+        return None
+
+    key = '%s-%s' % (_cache_key(activity), name)
+    with _cache_lock:
+        if key in _cache:
+            _stats.hits += 1
+            result = _cache.pop(key)
+            _cache[key] = result
+            return result
+
+    filename = None if _cache_dir is None else os.path.join(_cache_dir, key + '.json')
+    if filename is not None and os.path.isfile(filename):
+        _stats.hits += 1
+        with open(filename, 'r') as fh:
+            return _remember(key, json.load(fh))
+
+    _stats.misses += 1
+
+    global _last_streams
+    streams_key = _cache_key(activity)
+    if _last_streams[0] != streams_key:
+        _last_streams = (streams_key, get_streams(activity))
+    result = _remember(key, compute(_last_streams[1]))
+    logging.debug("Stream %s for activity ID=%s: %s" % (name, activity['activityId'], result))
+    if filename is not None:
+        with open(filename + '.tmp', 'w') as fh:
+            json.dump(result, fh)
+        os.rename(filename + '.tmp', filename)
+    return result
+
+
+def get_metrics(activity):
+    """Return StreamMetrics for an activity, or None without recordings"""
+    result = _cached(activity, 'metrics', lambda streams: list(compute_metrics(streams)))
+    return None if result is None else StreamMetrics(*result)
+
+
+def get_splits(activity, split_length):
+    """Return a list of split times in seconds for each complete split
+
+    split_length is in meters. None if the activity has no distance and
+    clock recordings.
+    """
+    def compute(streams):
+        splits = compute_splits(streams, split_length)
+        return None if splits is None else splits.tolist()
+    return _cached(activity, 'splits%g' % (split_length), compute)
+
+
+def _best_effort(streams, search, value):
+    distance = cumulative_distance(streams)
+    if distance is None or 'clock' not in streams:
+        return None
+    return search(distance, streams['clock'], value)
+
+
+def get_best_distance(activity, seconds):
+    """Return the most meters covered in any seconds long part of the run
+
+    None if the activity has no distance and clock recordings. Like the
+    other metrics the result is cached per activity and window.
+    """
+    return _cached(activity, 'bestdistance%g' % (seconds),
+                   lambda streams: _best_effort(streams, max_distance_within, seconds))
+
+
+def get_best_time(activity, meters):
+    """Return the fewest seconds taken to cover meters in any part of the run"""
+    return _cached(activity, 'besttime%g' % (meters),
+                   lambda streams: _best_effort(streams, min_time_for, meters))
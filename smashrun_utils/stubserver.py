@@ -0,0 +1,300 @@
+# vim: ft=python expandtab softtabstop=0 tabstop=4 shiftwidth=4
+#
+# Copyright (c) 2016, Jon Nall 
+# All rights reserved. 
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions are met: 
+# 
+#  * Redistributions of source code must retain the above copyright notice, 
+#    this list of conditions and the following disclaimer. 
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in the 
+#    documentation and/or other materials provided with the distribution. 
+#  * Neither the name of  nor the names of its contributors may be used to 
+#    endorse or promote products derived from this software without specific 
+#    prior written permission. 
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE. 
+
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import shlex
+import subprocess
+import threading
+import time
+import metrics
+import utils as sru
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+# A local stand-in for the Smashrun API and the Google Time Zone API, so the
+# network paths of sr-badgecalc and sr-fixdates can be run and benchmarked
+# without live accounts. Point the scripts at it with --smashrun_url and
+# --google_url. Responses come from fixtures: activities, user info and
+# badges for Smashrun and recorded offsets for Google (anything not recorded
+# gets the offset of its longitude's nautical time zone). Every request can
+# be slowed down by a latency with jitter and failed with a 429 or 5xx at a
+# given rate. Updates are counted but not applied, so repeated runs against
+# the same server do the same work.
+#
+#   POST /oauth2/token
+#   GET  /v1/my/userinfo
+#   GET  /v1/my/badges
+#   GET  /v1/my/activities/<id>
+#   GET  /v1/my/activities/search[/ids|/briefs|/extended]?fromDate=&count=&page=
+#   PUT  /v1/my/activities                body: the updated activity
+#   GET  /maps/api/timezone/json?location=<lat>,<lng>&timestamp=&key=
+
+def load_timezones(filename):
+    """Return recorded Google Time Zone responses keyed by 'lat,lng'
+
+    The file is a JSON object mapping the location parameter sr-fixdates
+    sends to {"rawOffset": seconds, "dstOffset": seconds}.
+    """
+    with open(filename, 'r') as fh:
+        return json.load(fh)
+
+
+def nautical_offset(lng):
+    return int(round(float(lng) / 15.0)) * 3600
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug("%s %s" % (self.address_string(), format % args))
+
+    def _reply(self, status, body, headers={}):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length).decode('utf-8')
+
+    def _handle(self, method):
+        start_time = time.time()
+        url = urlparse(self.path)
+        params = dict([(k, v[-1]) for k, v in parse_qs(url.query).items()])
+        try:
+            endpoint, status, body = self.server.route(method, url.path, params, self._body() if method != 'GET' else None)
+        except Exception as e:
+            logging.exception("Unable to serve %s %s" % (method, self.path))
+            endpoint, status, body = None, 500, {'error': str(e)}
+        self.server.delay()
+        headers = {}
+        injected = self.server.inject_error()
+        if injected is not None and endpoint is not None:
+            status, body = injected, {'error': 'Injected failure'}
+            if status == 429:
+                headers['Retry-After'] = '1'
+        self._reply(status, body, headers)
+        self.server.record(endpoint or 'unknown', status, time.time() - start_time)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Serves a StubSmashrun (and time zone fixtures) over HTTP
+
+    latency and jitter are in seconds; each response is delayed by latency
+    plus or minus up to jitter. A share error_rate of responses fail with
+    one of error_statuses. Pages of activities hold at most page_size
+    activities whatever count a client asks for.
+    """
+
+    daemon_threads = True
+    activity_re = re.compile(r'^/v1/my/activities/(\d+)$')
+    search_re = re.compile(r'^/v1/my/activities/search(?:/(ids|briefs|extended))?$')
+
+    def __init__(self, address, smashrun, timezones={}, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_statuses=(429, 500, 503), page_size=100, seed=None):
+        HTTPServer.__init__(self, address, StubRequestHandler)
+        self.smashrun = smashrun
+        self.timezones = timezones
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.page_size = page_size
+        self.updates = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._requests = {}  # endpoint -> list of seconds
+        self._statuses = {}  # status -> count
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def delay(self):
+        with self._lock:
+            seconds = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def inject_error(self):
+        with self._lock:
+            if self.error_rate > 0 and self._random.random() < self.error_rate:
+                return self._random.choice(self.error_statuses)
+        return None
+
+    def record(self, endpoint, status, seconds):
+        with self._lock:
+            self._requests.setdefault(endpoint, []).append(seconds)
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+
+    def route(self, method, path, params, body):
+        """Return (endpoint, status, response body) for a request"""
+        path = path.rstrip('/') or '/'
+        if method == 'POST' and path == '/oauth2/token':
+            return 'token', 200, {'access_token': 'stub', 'refresh_token': 'stub', 'token_type': 'Bearer', 'expires_in': 86400}
+        if method == 'GET' and path == '/maps/api/timezone/json':
+            return self._timezone(params)
+        if method == 'GET' and path == '/v1/my/userinfo':
+            return 'userinfo', 200, self.smashrun.get_userinfo()
+        if method == 'GET' and path == '/v1/my/badges':
+            return 'badges', 200, self.smashrun.get_badges()
+        if method == 'PUT' and path == '/v1/my/activities':
+            try:
+                activity = json.loads(body)
+                activity_id = activity['activityId']
+            except (ValueError, KeyError, TypeError) as e:
+                return 'update', 400, {'error': 'Invalid activity: %s' % (e)}
+            if activity_id not in self.smashrun.activities:
+                return 'update', 404, {'error': 'No such activity: %s' % (activity_id)}
+            with self._lock:
+                self.updates += 1
+            return 'update', 200, {}
+
+        match = self.activity_re.match(path)
+        if method == 'GET' and match is not None:
+            try:
+                return 'activity', 200, self.smashrun.get_activity(int(match.group(1)))
+            except KeyError:
+                return 'activity', 404, {'error': 'No such activity: %s' % (match.group(1))}
+
+        match = self.search_re.match(path)
+        if method == 'GET' and match is not None:
+            return 'search', 200, self._search(match.group(1) or 'summary', params)
+
+        return None, 404, {'error': 'Not found: %s %s' % (method, path)}
+
+    def _search(self, style, params):
+        since = None
+        if 'fromDate' in params:
+            # Seconds since 1970 in the activity's local time
+            since = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=int(params['fromDate']))
+        count = min(int(params.get('count') or self.page_size), self.page_size)
+        page = int(params.get('page') or 0)
+        return self.smashrun.listing(since, style)[page * count:(page + 1) * count]
+
+    def _timezone(self, params):
+        location = params.get('location', '')
+        try:
+            lat, lng = [float(x) for x in location.split(',')]
+        except ValueError:
+            return 'timezone', 200, {'status': 'INVALID_REQUEST'}
+        recorded = self.timezones.get(location)
+        if recorded is None:
+            recorded = {'rawOffset': nautical_offset(lng), 'dstOffset': 0}
+        result = {'status': 'OK', 'dstOffset': 0, 'rawOffset': 0}
+        result.update(recorded)
+        return 'timezone', 200, result
+
+    def stats(self):
+        """Return {'statuses': {status: count}, 'endpoints': {name: {...}}} with latencies in ms"""
+        with self._lock:
+            endpoints = {}
+            for endpoint, values in self._requests.items():
+                ms = [v * 1000.0 for v in values]
+                endpoints[endpoint] = {'requests': len(ms), 'p50': metrics.percentile(ms, 50),
+                                       'p99': metrics.percentile(ms, 99), 'max': max(ms)}
+            return {'statuses': dict(self._statuses), 'endpoints': endpoints, 'updates': self.updates}
+
+
+def start(server):
+    """Serve from a daemon thread, returning the thread"""
+    thread = threading.Thread(target=server.serve_forever, name='stub-server')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def drive(command, runs=1, concurrency=1, substitutions={}):
+    """Run command runs times, concurrency at a time, and return timing statistics in seconds
+
+    command is a shell style string; {run} and any key of substitutions are
+    replaced in it. A run fails if the command exits non-zero.
+    """
+    times = []
+    failures = []
+    lock = threading.Lock()
+    pending = list(range(runs))
+
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                run = pending.pop(0)
+            values = dict(substitutions)
+            values['run'] = run
+            argv = [part.format(**values) for part in shlex.split(command)]
+            start_time = time.time()
+            with open(os.devnull, 'w') as devnull:
+                returncode = subprocess.call(argv, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start_time
+            with lock:
+                times.append(elapsed)
+                if returncode != 0:
+                    failures.append((run, returncode))
+
+    start_time = time.time()
+    threads = [threading.Thread(target=work) for i in range(min(concurrency, runs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start_time
+
+    return {'runs': len(times),
+            'failures': failures,
+            'p50': metrics.percentile(times, 50),
+            'p99': metrics.percentile(times, 99),
+            'max': max(times),
+            'throughput': len(times) / elapsed if elapsed > 0 else 0.0}
@@ -29,18 +29,69 @@
 
 import dateutil
 import ephem
+import logging
+import os
 import re
 import sys
+import metrics
 from datetime import datetime
 from datetime import timedelta
 from dateutil.tz import tzoffset
 from pint import UnitRegistry
+from pint import set_application_registry
 
 
 UNITS = UnitRegistry()
+# Pickled quantities are restored against the application registry. Make
+# that ours so saved badge state can be loaded back and compared with UNITS.
+set_application_registry(UNITS)
+
+
+# Where Google Time Zone API requests go unless told otherwise
+GOOGLE_URL = 'https://maps.googleapis.com'
+
+
+def point_at(client, url):
+    """Make a smashrun.client.Smashrun send every request to url instead
+
+    Call before refresh_token(). OAuth over plain http is allowed when url
+    is an http URL.
+    """
+    if url.startswith('http://'):
+        os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+    url = url.rstrip('/')
+    client.base_url = url + '/v1'
+
+    def refresh_token(**kwargs):
+        kwargs.setdefault('client_id', client.client_id)
+        kwargs.setdefault('client_secret', client.client_secret)
+        return client.session.refresh_token(url + '/oauth2/token', **kwargs)
+    client.refresh_token = refresh_token
+    return client
+
+
+# The same start times are parsed by many badges for every activity.
+# Datetimes are immutable so parsed values are shared.
+SRDATE_CACHE_SIZE = 100000
+_srdate_cache = {}
+_srdate_stats = metrics.cache('srdate')
 
 
 def srdate_to_datetime(datestring, utc=False):
+    key = (datestring, utc)
+    result = _srdate_cache.get(key)
+    if result is not None:
+        _srdate_stats.hits += 1
+        return result
+
+    _srdate_stats.misses += 1
+    if len(_srdate_cache) >= SRDATE_CACHE_SIZE:
+        _srdate_cache.clear()
+    result = _srdate_cache[key] = _parse_srdate(datestring, utc)
+    return result
+
+
+def _parse_srdate(datestring, utc):
     # 2016-11-17T07:11:00-08:00
 
     if utc:
@@ -63,6 +114,42 @@ def srdate_to_datetime(datestring, utc=False):
     return result.replace(tzinfo=to_zone)
 
 
+# Smashrun query styles from least to most data. Recordings only come with
+# a single 'detailed' activity and can't be requested in bulk.
+QUERY_STYLES = ['ids', 'briefs', 'summary', 'extended', 'detailed']
+
+# The first query style that includes each activity field
+FIELD_STYLES = {'activityId': 'ids',
+                'startDateTimeLocal': 'briefs',
+                'distance': 'briefs',
+                'duration': 'briefs',
+                'startLatitude': 'summary',
+                'startLongitude': 'summary',
+                'elevationGain': 'extended',
+                'isTreadmill': 'extended',
+                'speedVariability': 'extended',
+                'state': 'extended',
+                'countryCode': 'extended',
+                'sunriseLocal': 'extended',
+                'sunsetLocal': 'extended',
+                'moonPhase': 'extended',
+                'recordingKeys': 'detailed',
+                'recordingValues': 'detailed'}
+
+
+def query_style(fields):
+    """Return the smallest bulk query style that includes every field"""
+    # Anything unknown is assumed to need the full record
+    styles = [FIELD_STYLES.get(f, 'extended') for f in fields] + ['briefs']
+    style = max(styles, key=QUERY_STYLES.index)
+    return 'extended' if style == 'detailed' else style
+
+
+def prune_activity(activity, fields):
+    """Return a copy of activity holding only fields"""
+    return dict([(k, v) for k, v in activity.items() if k in fields])
+
+
 def assert_activity_field(activity, key, required_query_type):
     if key not in activity:
         raise RuntimeError("Requested value '%s' not in activity ID=%s. Make sure you request at least %s fields" %
@@ -116,9 +203,16 @@ def get_elevations(activity):
 
 
 def elevation_gain(activity):
-    if 'elevationGain' not in activity:
-        logging.warning("No elevationGain for activity ID=%s. Consider correcting it on the website and trying again" % (activity['activityId']))
+    if activity.get('elevationGain') is None:
         e = 0
+        if activity.get('isTreadmill'):
+            pass
+        elif activity.get('recordingKeys') and 'elevation' in activity['recordingKeys']:
+            # Imported here so numpy is only needed for detailed activities
+            import streams
+            e = streams.get_metrics(activity).elevation_gain
+        else:
+            logging.warning("No elevationGain for activity ID=%s. Consider correcting it on the website and trying again" % (activity['activityId']))
     else:
         assert_activity_field(activity, 'isTreadmill', 'extended')
         assert_activity_field(activity, 'elevationGain', 'extended')